@@ -0,0 +1,200 @@
+"""ai.py - The computer opponent for single-player games.
+
+The computer is a regular user called NAME who plays as player 2. On boards
+up to HEATMAP_MAX_SIZE wide it picks each shot from a probability-density
+heatmap: every placement of each of the opponent's unsunk ships that avoids
+its misses and the sunk ships adds weight to the cells it covers, and
+placements through hits on unsunk ships count HIT_WEIGHT times more, so it
+finishes off a ship once it has found one.
+
+The placements of each ship length are kept as a boolean NumPy matrix (one
+row per placement, one column per cell) so a heatmap is a couple of matrix
+operations per ship. Without NumPy the same heatmap is built from bitmasks in
+pure Python.
+
+A heatmap costs in proportion to the board's area, so on larger boards the
+computer hunts and targets instead: it shoots next to its hits on unsunk
+ships, extending lines of hits first, and otherwise at random cells of a
+checkerboard spaced by the shortest unsunk ship."""
+
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from board import cell, cells_mask, mask_cells, on_board, placements
+
+
+NAME = 'Computer'
+HIT_WEIGHT = 20
+HEATMAP_MAX_SIZE = 20
+# random draws for a hunting shot before falling back to a scan of the board
+HUNT_ATTEMPTS = 50
+
+# (length, size) -> placement masks, and their cells / NumPy matrix, built on first use
+_tables = {}
+
+
+def _table(length, size):
+    key = (length, size)
+    if key not in _tables:
+        masks = [mask for x, y, vertical, mask in placements(length, size)]
+        if numpy is not None:
+            _tables[key] = numpy.array([_vector(mask_cells(mask), size * size) for mask in masks])
+        else:
+            _tables[key] = [(mask, mask_cells(mask)) for mask in masks]
+    return _tables[key]
+
+
+def _vector(cells, n):
+    ''' cells as a NumPy boolean vector of n cells '''
+    vector = numpy.zeros(n, dtype=bool)
+    vector[list(cells)] = True
+    return vector
+
+
+def _knowledge(board, player):
+    ''' what player knows about the opponent's board from its own shots:
+        cells no unsunk ship can cover, hits on unsunk ships, and the lengths
+        of the unsunk ships '''
+    opponent = 3 - player
+    blocked = set(board.misses(opponent))
+    lengths = []
+    for name, cells in board.fleets[opponent - 1].items():
+        if board.is_sunk(opponent, name):
+            blocked.update(cells)
+        else:
+            lengths.append(len(cells))
+    hits = set(c for c in board.hits(opponent) if c not in blocked)
+    return blocked, hits, lengths
+
+
+def heatmap(board, player):
+    ''' per-cell weight (indexed by board.cell) of player's next shot '''
+    blocked, hits, lengths = _knowledge(board, player)
+    n = board.size * board.size
+    if numpy is not None:
+        blocked, hits = _vector(blocked, n), _vector(hits, n)
+        heat = numpy.zeros(n)
+        for length in lengths:
+            table = _table(length, board.size)
+            legal = ~table[:, blocked].any(axis=1)
+            weights = legal * (1 + HIT_WEIGHT * table[:, hits].sum(axis=1))
+            heat += weights.dot(table)
+        return heat
+
+    blocked, hits = cells_mask(blocked), cells_mask(hits)
+    heat = [0] * n
+    for length in lengths:
+        for mask, cells in _table(length, board.size):
+            if mask & blocked:
+                continue
+            weight = 1 + HIT_WEIGHT * bin(mask & hits).count('1')
+            for c in cells:
+                heat[c] += weight
+    return heat
+
+
+def choose_shot(board, player, rng=random):
+    ''' the x, y of player's next shot '''
+    return choose_salvo(board, player, 1, rng)[0]
+
+
+def choose_salvo(board, player, count, rng=random):
+    ''' the x, y of count different shots fired together. they all come
+        from what is known now, since none of their results are known yet '''
+    if board.size > HEATMAP_MAX_SIZE:
+        return _hunt_and_target(board, player, count, rng)
+    heat = heatmap(board, player)
+    taken = set(board.shots[player - 1])
+    salvo = []
+    for _ in range(count):
+        c = _hottest(heat, taken, board.size * board.size, rng)
+        taken.add(c)
+        salvo.append((c % board.size, c // board.size))
+    return salvo
+
+
+def _hottest(heat, taken, n, rng):
+    ''' the hottest cell not in taken, ties broken at random '''
+    best, cells = None, []
+    for c in range(n):
+        if c in taken:
+            continue
+        if best is None or heat[c] > best:
+            best, cells = heat[c], [c]
+        elif heat[c] == best:
+            cells.append(c)
+    return cells[rng.randrange(len(cells))]
+
+
+def _hunt_and_target(board, player, count, rng):
+    ''' shots next to hits on unsunk ships first, then hunting shots '''
+    blocked, hits, lengths = _knowledge(board, player)
+    taken = set(board.shots[player - 1])
+    size = board.size
+    salvo = []
+    for c in _targets(hits, taken, size):
+        if len(salvo) == count:
+            break
+        taken.add(c)
+        salvo.append((c % size, c // size))
+    spacing = min(lengths) if lengths else 1
+    pool = None
+    while len(salvo) < count:
+        c = _hunt(taken, size, spacing, rng) if pool is None else None
+        if c is None:
+            # random draws no longer find open cells: scan the board once
+            # for the rest of the salvo
+            if pool is None:
+                pool = _hunt_pool(taken, size, spacing, rng)
+            c = pool.pop()
+        taken.add(c)
+        salvo.append((c % size, c // size))
+    return salvo
+
+
+def _targets(hits, taken, size):
+    ''' the unshot neighbours of hits, those that extend a line of two hits first '''
+    lines, others = [], []
+    for c in sorted(hits):
+        x, y = c % size, c // size
+        for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            if not on_board(x + dx, y + dy, size):
+                continue
+            n = cell(x + dx, y + dy, size)
+            if n in taken:
+                continue
+            behind = on_board(x - dx, y - dy, size) and cell(x - dx, y - dy, size) in hits
+            (lines if behind else others).append(n)
+    seen = set()
+    return [c for c in lines + others if not (c in seen or seen.add(c))]
+
+
+def _spaced(c, size, spacing):
+    ''' whether (x + y) of cell c is divisible by spacing: every ship at
+        least spacing long covers such a cell '''
+    return (c % size + c // size) % spacing == 0
+
+
+def _hunt(taken, size, spacing, rng):
+    ''' a random unshot spaced cell, or None if HUNT_ATTEMPTS draws miss '''
+    for _ in range(HUNT_ATTEMPTS):
+        c = rng.randrange(size * size)
+        if _spaced(c, size, spacing) and c not in taken:
+            return c
+    return None
+
+
+def _hunt_pool(taken, size, spacing, rng):
+    ''' every unshot cell in random order, spaced cells at the end so they
+        are popped first '''
+    spaced, others = [], []
+    for c in range(size * size):
+        if c not in taken:
+            (spaced if _spaced(c, size, spacing) else others).append(c)
+    rng.shuffle(spaced)
+    rng.shuffle(others)
+    return others + spaced
@@ -1,29 +1,64 @@
 # -*- coding: utf-8 -*-`
 """api.py - Create and configure the Game API exposing the resources.
-This can also contain game logic. For more complex games it would be wise to
-move game logic to another file. Ideally the API will be simple, concerned
-primarily with communication to/from the API's users."""
+The rules of the game are in rules.py, and every read and write goes through
+storage, an NdbStorage in production. Setting api.storage to a
+storage.MemoryStorage runs the same handlers without a datastore. Ideally the
+API will be simple, concerned primarily with communication to/from the API's
+users."""
 
 
-import logging
+import time
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-from models import User, Game, Move, Position, Ship, SHIPS, BOARD_SIZE
+from models import RANKINGS_PAGE_SIZE, USER_GAMES_PAGE_SIZE
+from models import HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE
 from models import StringMessage, NewGameForm, GameForm, PositionForm
 from models import MakeMoveForm, MoveResponse, MultiGamesMessage, GameRankings, RankLineItem
 from models import FullGameInfo, MoveMessage, ShipMessage, XYMessage
-from utils import get_by_urlsafe
+from models import FleetForm, FleetResponse, ShipErrorMessage
+from models import GamePollResponse, ShotResultMessage, SalvoForm, SalvoResponse
+from models import BoardResponse, BoardLayersMessage, StatsMessage, ShipSpecMessage
+from board import GameException, cell, cell_xy, pack_cells
+from storage import InvalidId, InvalidCursor, Contention
+from ndb_storage import NdbStorage
+from utils import LRUCache
+from instrumentation import instrumented
+from ratelimit import rate_limited
+import rules
+import ai
+
+
+# where games and users are kept; see storage.py
+storage = NdbStorage()
+
+
+# longest a poll_game request waits for a change, and how often it checks
+MAX_POLL_WAIT = 10
+POLL_INTERVAL = 0.25
+
+# get_board's packed boards by (game id, version, viewer); a version's boards never change
+_boards = LRUCache(2000)
 
 
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GET_BOARD_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1, required=True),
+        user_name=messages.StringField(2),
+        mine_only=messages.BooleanField(3, default=False),
+        version=messages.IntegerField(4))
+POLL_GAME_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1, required=True),
+        version=messages.IntegerField(2),
+        wait=messages.IntegerField(3, default=0))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_SALVO_REQUEST = endpoints.ResourceContainer(
+    SalvoForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 
@@ -31,7 +66,26 @@ NEW_POSITION_FORM = endpoints.ResourceContainer(
                         PositionForm,
                         urlsafe_game_key=messages.StringField(1, required=True))
 
-GET_USER_GAMES = endpoints.ResourceContainer(user_name=messages.StringField(1))
+PLACE_FLEET_FORM = endpoints.ResourceContainer(
+                        FleetForm,
+                        urlsafe_game_key=messages.StringField(1, required=True))
+
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+                        page_size=messages.IntegerField(1, default=RANKINGS_PAGE_SIZE),
+                        cursor=messages.StringField(2))
+
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+                        urlsafe_game_key=messages.StringField(1),
+                        since_seq=messages.IntegerField(2),
+                        page_size=messages.IntegerField(3, default=HISTORY_PAGE_SIZE))
+
+STATS_REQUEST = endpoints.ResourceContainer(
+                        user_name=messages.StringField(1))
+
+GET_USER_GAMES = endpoints.ResourceContainer(
+                        user_name=messages.StringField(1),
+                        page_size=messages.IntegerField(2, default=USER_GAMES_PAGE_SIZE),
+                        cursor=messages.StringField(3))
 
 @endpoints.api(name='battleship', version='v1')
 class BattleshipApi(remote.Service):
@@ -41,13 +95,18 @@ class BattleshipApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
+    @rate_limited
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user_name is required.')
+        if request.user_name == ai.NAME:
+            raise endpoints.ConflictException('That name is reserved for the computer.')
+        # the name is checked against the index in create_user's transaction
+        if not storage.create_user(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -56,104 +115,418 @@ class BattleshipApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
+    @rate_limited
     def new_game(self, request):
-        """Creates new game"""
-        p1 = User.by_name(request.player_1)
-        if request.player_2:
-            p2 = User.by_name(request.player_2)
-        else:
-            p2 = none
+        """Creates new game. Without player_2 the computer plays player 2"""
+        # the computer only ever plays player 2
+        if request.player_1 == ai.NAME:
+            raise endpoints.BadRequestException('The computer can only be player 2.')
+        # both lookups run concurrently
+        p1_future = storage.user_by_name_async(request.player_1)
+        p2_future = storage.user_by_name_async(request.player_2 or ai.NAME)
+        p1, p2 = p1_future.get_result(), p2_future.get_result()
+        if not request.player_2 and not p2:
+            p2 = storage.create_user(ai.NAME) or storage.user_by_name_async(ai.NAME).get_result()
         if not p1 or not p2:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
+        size = request.board_size
+        ships = None
+        if request.ships:
+            ships = {s.name: s.length for s in request.ships}
+            if len(ships) != len(request.ships):
+                raise endpoints.BadRequestException('Every ship needs its own name.')
+        try:
+            rules.check_setup(size, ships or rules.SHIPS)
+        except GameException, e:
+            raise endpoints.BadRequestException(str(e))
+        if not 0 < request.salvo <= rules.MAX_SALVO:
+            raise endpoints.BadRequestException(
+                    'salvo must be between 1 and {}.'.format(rules.MAX_SALVO))
         try:
-            game = Game.new_game(p1.key, p2.key)
+            game = storage.new_game(p1.key, p2.key, request.compact, request.salvo, size, ships)
         except:
             raise endpoints.BadRequestException('bad request!')
 
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        # taskqueue.add(url='/tasks/cache_average_attempts')
-        return game.to_form('Good luck playing Battleship!')
+        # the computer's fleet is always placed at random
+        players = [p for p in (1, 2) if request.auto_place.number & p]
+        if p2.name == ai.NAME and 2 not in players:
+            players.append(2)
+        if players:
+            self._auto_place(game, players)
+        return self._game_form(game, 'Good luck playing Battleship!')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._get_game(request.urlsafe_game_key)
         if game:
-            return game.to_form('Time to make a move!')
+            return self._game_form(game, 'Time to make a move!')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=POLL_GAME_REQUEST,
+                      response_message=GamePollResponse,
+                      path='game/{urlsafe_game_key}/poll',
+                      name='poll_game',
+                      http_method='GET')
+    @instrumented
+    @rate_limited
+    def poll_game(self, request):
+        """Cheap check for changes to a game. If version is the client's
+           last-seen version and the game is unchanged, answers changed=False
+           from memcache without reading the game. With wait (seconds, at most
+           MAX_POLL_WAIT) it keeps checking until the version changes"""
+        game_id = request.urlsafe_game_key
+        try:
+            version = storage.game_version(game_id)
+        except InvalidId:
+            raise endpoints.BadRequestException('Invalid Key')
+        if version is None:
+            raise endpoints.NotFoundException('Game not found!')
+        deadline = time.time() + min(max(request.wait, 0), MAX_POLL_WAIT)
+        while version == request.version and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            version = storage.game_version(game_id)
+        if version == request.version:
+            return GamePollResponse(version=version, changed=False)
+
+        game = self._get_game(game_id)
+        return GamePollResponse(version=game.version, changed=True,
+                                game=self._game_form(game, 'Time to make a move!'))
+
+    @endpoints.method(request_message=GET_BOARD_REQUEST,
+                      response_message=BoardResponse,
+                      path='game/{urlsafe_game_key}/board',
+                      name='get_board',
+                      http_method='GET')
+    @instrumented
+    @rate_limited
+    def get_board(self, request):
+        """Both players' boards as packed ship, hit and miss layers. With
+           mine_only, user_name's view: their own board and only their shots
+           at the opponent's. If version is the client's last-seen version and
+           the game is unchanged, answers changed=False without reading the
+           game. Boards are cached per version"""
+        game_id = request.urlsafe_game_key
+        try:
+            version = storage.game_version(game_id)
+        except InvalidId:
+            raise endpoints.BadRequestException('Invalid Key')
+        if version is None:
+            raise endpoints.NotFoundException('Game not found!')
+        if version == request.version:
+            return BoardResponse(version=version, changed=False)
+
+        viewer = None
+        if request.mine_only:
+            viewer = storage.user_key(request.user_name)
+            if not viewer:
+                raise endpoints.NotFoundException('User does not exist!')
+
+        response = _boards.get((game_id, version, viewer))
+        if response is None:
+            game = self._get_game(game_id)
+            if viewer and viewer not in (game.p1, game.p2):
+                raise endpoints.BadRequestException('User is not playing that game.')
+            response = self._board_response(game, viewer)
+            _boards.set((game_id, response.version, viewer), response)
+        return response
+
+    def _board_response(self, game, viewer):
+        ''' the packed boards of game as seen by viewer (a user key), or
+            by an onlooker who sees everything if viewer is None '''
+        board = storage.board(game)
+        boards = []
+        for player in (1, 2):
+            layers = BoardLayersMessage(player=player,
+                                        hits=pack_cells(board.hits(player), board.size),
+                                        misses=pack_cells(board.misses(player), board.size))
+            if viewer is None or rules.player_num(game, viewer) == player:
+                layers.ships = pack_cells(board.occupied(player), board.size)
+            boards.append(layers)
+        return BoardResponse(version=game.version, changed=True, size=board.size,
+                             status=game.status, boards=boards)
+
     @endpoints.method(request_message=NEW_POSITION_FORM,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}/position',
                       name='place_ship',
                       http_method='POST')
+    @instrumented
+    @rate_limited
     def place_ship(self, request):
         """Places a ship at an x,y coord. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if not game:
-            raise endpoints.NotFoundException('Game not found!')
+        game, player_num = self._setup_game(request)
 
-        if game.status == 'game over':
-            raise endpoints.BadRequestException('Game already over!')
+        if request.auto_place:
+            self._auto_place(game, [player_num])
+            return self._game_form(game, 'Success! Placed all remaining ships for ' + request.user_name + '.')
+        if request.ship is None or request.x is None or request.y is None:
+            raise endpoints.BadRequestException('ship, x and y are required unless auto_place is set.')
 
-        if game.status == 'p1 move' or game.status == 'p2 move':
-            raise endpoints.BadRequestException('Game already in progress! ' + game.status)
-
-        player = User.by_name(request.user_name)
-        if not player:
-            raise endpoints.NotFoundException('User does not exist!')
-        if player.key != game.p1 and player.key != game.p2:
-            raise endpoints.BadRequestException('User is not playing that game.')
-
-        remaining_tup = game.remaining_ships_to_setup()
-        if player.key == game.p1:
-            player_num = 1
-        if player.key == game.p2:
-            player_num = 2
+        remaining_tup = rules.remaining_ships(game)
 
         # if submitted ship still needs to be placed, try adding the ship
         if request.ship in remaining_tup[player_num - 1]:
+            placement = (request.ship, request.x, request.y, request.vertical_orientation)
             try:
-                game.add_ship(player_num, request.ship, request.x, request.y, request.vertical_orientation)
-            except:
+                errors = self._place_ships(game, player_num, [placement])
+            except Contention:
+                raise endpoints.ConflictException('The game is busy, please try again.')
+            if errors:
                 raise endpoints.BadRequestException('Invalid position or ship! ' + ('The remaining ships for that player are ' + ', '.join(remaining_tup[player_num - 1]) or 'No ships remaining to place.'))
 
-            remaining = game.remaining_ships_to_setup()
-            ship_list = remaining[player_num - 1]
+            # the game begins as soon as there are no ships remaining to be added
+            ship_list = rules.remaining_ships(game)[player_num - 1]
             if ship_list:
                 msg = 'Success! ' + request.user_name + ' needs to add ' + ', '.join(ship_list) + '.'
             else:
                 msg = 'Success! No remaining ships to add, ' + request.user_name + '.'
-
-            # if there are not ships remaining to be added to the board, let the game begin
-            if not remaining[0] and not remaining[1]:
-                game.status = 'p1 move'
-                game.put()
-            return game.to_form(msg)
+            return self._game_form(game, msg)
 
         # exception for submitting a ship that is already on the board or invalid ship
         raise endpoints.BadRequestException('Not a valid move. ' + ('The remaining ships for that player are ' + ', '.join(remaining_tup[player_num - 1]) or 'No ships remaining to place.'))
 
+    @endpoints.method(request_message=PLACE_FLEET_FORM,
+                      response_message=FleetResponse,
+                      path='game/{urlsafe_game_key}/fleet',
+                      name='place_fleet',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    def place_fleet(self, request):
+        """Places several (usually all five) of a player's ships in one transaction.
+           If any ship is invalid, nothing is placed and the errors are returned per ship"""
+        game, player_num = self._setup_game(request)
+        if not request.ships:
+            raise endpoints.BadRequestException('No ships to place.')
+
+        placements = [(s.ship, s.x, s.y, s.vertical_orientation) for s in request.ships]
+        try:
+            errors = self._place_ships(game, player_num, placements)
+        except Contention:
+            raise endpoints.ConflictException('The game is busy, please try again.')
+        if errors:
+            return FleetResponse(
+                game=self._game_form(game, 'No ships were placed.'),
+                errors=[ShipErrorMessage(ship=ship, message=msg) for ship, msg in errors])
+
+        ship_list = rules.remaining_ships(game)[player_num - 1]
+        if ship_list:
+            msg = 'Success! ' + request.user_name + ' needs to add ' + ', '.join(ship_list) + '.'
+        else:
+            msg = 'Success! No remaining ships to add, ' + request.user_name + '.'
+        return FleetResponse(game=self._game_form(game, msg))
+
+    def _place_ships(self, game, player, placements):
+        '''
+        places player's ships in one update of the game. every placement is
+        validated against the board first; if any of them is invalid nothing
+        is written and a list of (ship_name, error message) is returned.
+        the game starts once both fleets are complete
+        '''
+        def place(current):
+            errors, records = rules.place_ships(current, player, placements)
+            if errors:
+                return errors, None
+            rules.start_if_ready(current)
+            return errors, records
+        return storage.update_game(game, place)
+
+    def _auto_place(self, game, players):
+        ''' places every remaining ship of each player in players (1 and/or 2)
+            at random. raises BadRequestException if the ships placed by hand
+            leave no room for the rest '''
+        def place(current):
+            records = []
+            for player in players:
+                records.extend(rules.place_ships(
+                        current, player, rules.random_placements(current, player))[1])
+            rules.start_if_ready(current)
+            return None, records
+        try:
+            storage.update_game(game, place)
+        except GameException, e:
+            raise endpoints.BadRequestException(str(e))
+        except Contention:
+            raise endpoints.ConflictException('The game is busy, please try again.')
+
+    def _get_game(self, game_id):
+        return self._get_game_async(game_id).get_result()
+
+    def _get_game_async(self, game_id):
+        try:
+            return storage.get_game_async(game_id)
+        except InvalidId:
+            raise endpoints.BadRequestException('Invalid Key')
+
+    def _game_form(self, game, message, names=None):
+        """Returns a GameForm representation of the Game.
+           names is an optional dict of user key -> name, see storage.user_names"""
+        if names is None:
+            names = storage.user_names([game.p1, game.p2])
+        return GameForm(urlsafe_key=storage.game_id(game),
+                        p1=names.get(game.p1),
+                        p2=names.get(game.p2),
+                        status=game.status,
+                        message=message,
+                        created_date=game.created,
+                        version=game.version,
+                        salvo=game.salvo,
+                        board_size=game.board.size if game.board else rules.BOARD_SIZE,
+                        ships=[ShipSpecMessage(name=name, length=length)
+                               for name, length in sorted(rules.fleet(game).items())])
+
+    def _setup_game(self, request):
+        ''' returns the game and player number for a ship placement request
+            after checking the game is still being set up '''
+        game_future = self._get_game_async(request.urlsafe_game_key)
+        player_future = storage.user_by_name_async(request.user_name)
+        game = game_future.get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+
+        if game.status == 'game over':
+            raise endpoints.BadRequestException('Game already over!')
+
+        if game.status == 'p1 move' or game.status == 'p2 move':
+            raise endpoints.BadRequestException('Game already in progress! ' + game.status)
+
+        player = player_future.get_result()
+        if not player:
+            raise endpoints.NotFoundException('User does not exist!')
+        if player.key != game.p1 and player.key != game.p2:
+            raise endpoints.BadRequestException('User is not playing that game.')
+
+        storage.board(game)
+        return game, rules.player_num(game, player.key)
+
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=MoveResponse, #hit, ship, sunk
                       path='game/{urlsafe_game_key}/move',
                       name='make_move',
                       http_method='POST')
+    @instrumented
+    @rate_limited
+    @ndb.toplevel
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        player = User.by_name(request.user_name)
+        game, player, opponent_future = self._load_turn(request)
+
+        ## coordinates
+        x = int(request.x)
+        y = int(request.y)
+
+        # attempt move. turn and repeated shots are checked again inside the
+        # transaction, so a double submit can only be applied once
+        # against the computer, its reply is fired in the same transaction
+        def fire(current):
+            opponent = opponent_future.get_result()
+            shot, records = rules.fire(current, player.key, x, y)
+            records.append((rules.NOTIFY, self._move_notices(player, opponent, x, y, shot)))
+            reply = None
+            if opponent.name == ai.NAME and not shot.game_over:
+                rx, ry = ai.choose_shot(current.board, 2)
+                reply_shot, reply_records = rules.fire(current, opponent.key, rx, ry)
+                records.extend(reply_records)
+                if reply_shot.game_over:
+                    records.append((rules.NOTIFY, self._move_notices(opponent, player, rx, ry, reply_shot)))
+                reply = (rx, ry, reply_shot)
+            return (shot, reply), records
+        try:
+            shot, reply = storage.update_game(game, fire, 'make_move')
+        except GameException, e:
+            raise endpoints.BadRequestException(str(e))
+        except Contention:
+            raise endpoints.ConflictException('The game is busy, please try again.')
+
+        response = self._move_response(shot, x, y)
+        if reply:
+            self._add_computer_move(response, *reply)
+        return response
+
+    @endpoints.method(request_message=MAKE_SALVO_REQUEST,
+                      response_message=SalvoResponse,
+                      path='game/{urlsafe_game_key}/salvo',
+                      name='make_salvo',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    @ndb.toplevel
+    def make_salvo(self, request):
+        """Fires all of a turn's shots in one request. Returns each shot's result"""
+        game, player, opponent_future = self._load_turn(request)
+        cells = [(s.x, s.y) for s in request.shots]
+
+        # the whole salvo (and the computer's reply) is one transaction
+        def fire(current):
+            opponent = opponent_future.get_result()
+            shots, records = rules.fire_salvo(current, player.key, cells)
+            records.append((rules.NOTIFY, self._salvo_notices(player, opponent, shots)))
+            replies = []
+            if opponent.name == ai.NAME and not shots[-1].game_over:
+                reply_cells = ai.choose_salvo(current.board, 2, rules.shots_per_turn(current, 2))
+                reply_shots, reply_records = rules.fire_salvo(current, opponent.key, reply_cells)
+                records.extend(reply_records)
+                if reply_shots[-1].game_over:
+                    records.append((rules.NOTIFY, self._salvo_notices(opponent, player, reply_shots)))
+                replies = zip(reply_cells, reply_shots)
+            return (shots, replies), records
+        try:
+            shots, replies = storage.update_game(game, fire, 'make_salvo')
+        except GameException, e:
+            raise endpoints.BadRequestException(str(e))
+        except Contention:
+            raise endpoints.ConflictException('The game is busy, please try again.')
+
+        hits = sum(1 for s in shots if s.hit)
+        sunk = [s.ship for s in shots if s.sunk]
+        message = '{} of {} shots hit.'.format(hits, len(shots))
+        if sunk:
+            message += ' Sunk ' + ', '.join(sunk) + '!'
+        if shots[-1].game_over:
+            message += ' Game over! You win!'
+        response = SalvoResponse(results=self._shot_results(zip(cells, shots)),
+                                 game_over=shots[-1].game_over,
+                                 message=message)
+        if replies:
+            reply_shots = [s for _, s in replies]
+            response.computer_shots = self._shot_results(replies)
+            response.game_over = reply_shots[-1].game_over
+            response.message += ' The computer hit {} of {} shots.'.format(
+                    sum(1 for s in reply_shots if s.hit), len(reply_shots))
+            sunk = [s.ship for s in reply_shots if s.sunk]
+            if sunk:
+                response.message += ' It sunk your ' + ', '.join(sunk) + '!'
+            if response.game_over:
+                response.message += ' Game over! You lose!'
+        return response
+
+    def _shot_results(self, shots):
+        ''' ShotResultMessages for a list of ((x, y), Shot) '''
+        return [ShotResultMessage(x=x, y=y, hit=shot.hit, ship=shot.ship, sunk=shot.sunk)
+                for (x, y), shot in shots]
+
+    def _load_turn(self, request):
+        ''' returns the game, the player and a future for the opponent for a
+            move request, after checking it is the player's turn '''
+        # the game and the player don't depend on each other, so fetch both at once
+        game_future = self._get_game_async(request.urlsafe_game_key)
+        player_future = storage.user_by_name_async(request.user_name)
+        game, player = game_future.get_result(), player_future.get_result()
 
         # preflight checks for valid request
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         if not player:
             raise endpoints.BadRequestException('User not found!')
         if game.status == 'game over':
@@ -163,110 +536,94 @@ class BattleshipApi(remote.Service):
         if game.p1 != player.key and game.p2 != player.key:
             raise endpoints.BadRequestException('The specified user is not playing the specified game.')
 
-        #  determine who is making a move and if it's really their turn
-        if game.p1 == player.key:
-            opponent = game.p2.get()
-            if game.status == 'p2 move':
-                raise endpoints.BadRequestException('Error: It is ' + opponent.name + '\'s turn!')
-        else:
-            opponent = game.p1.get()
-            if game.status == 'p1 move':
-                raise endpoints.BadRequestException('Error: It is ' + opponent.name + '\'s turn!')
+        #  determine who is making a move and if it's really their turn.
+        #  the opponent is only needed for messages, so it loads in the background
+        opponent_future = storage.get_user_async(game.p2 if game.p1 == player.key else game.p1)
+        if game.status != 'p{} move'.format(rules.player_num(game, player.key)):
+            raise endpoints.BadRequestException('Error: It is ' + opponent_future.get_result().name + '\'s turn!')
+        return game, player, opponent_future
 
-        ## coordinates
-        x = int(request.x)
-        y = int(request.y)
+    def _move_response(self, shot, x, y):
+        if shot.game_over:
+            # return game over MoveResponse
+            return MoveResponse(hit=True, ship=shot.ship, sunk=True, message='Hit! Sunk! Game over! You win!')
 
-        if x not in range(BOARD_SIZE) or y not in range(BOARD_SIZE):
-            raise endpoints.BadRequestException('Attempted move is off the board.')
-
-        # attempt move
-        if Move.get_move(game, player, x, y):
-            raise endpoints.BadRequestException('You already made that move')
-
-        # we have determined player is making a valid move, so switch whose turn it is
-        if game.status == 'p1 move':
-            game.status = 'p2 move'
-        else:
-            game.status = 'p1 move'
-        game.put()
+        if shot.sunk:
+            #return sunk ship message
+            return MoveResponse(hit=True, ship=shot.ship, sunk=True, message="Hit! Sunk "+ shot.ship + "!")
 
-        # create a Move object
-        move = Move(parent=game.key, player=player.key, x=x, y=y)
-        move.put()
+        if shot.hit:
+            # return hit message
+            return MoveResponse(hit=True, ship=shot.ship, sunk=False, message="Hit on "+ shot.ship + "!")
 
-
-        # check for hits
-        ships = Ship.query(ancestor=game.key).filter(Ship.player==opponent.key).fetch()
-        position = None # position that was hit, if any
-        ship = None # ship that was hit, if any
-        to_put = []
-        for s in ships:
-            position = Position.query(ancestor=s.key).filter(Position.x==x,Position.y==y).get()
-
-            if position:
-                position.hit = True
-                position.put()
-                positions = Position.query(ancestor=s.key).fetch()
-                hit_positions = [p for p in positions if p.hit == True]
-
-                if positions == hit_positions:
-                    s.sunk = True
-                    s.put()
-                    sunk_ships = [sunk for sunk in ships if sunk.sunk == True]
-
-                    if sunk_ships == ships:
-                        game.status = 'game over'
-                        game.winner = player.key
-                        game.put()
-
-                        # send game-over email
-                        message = '{} sunk {}! The game is over and {} won!'.format(player.name, s.ship, player.name)
-                        self.sendEmail(player, game, message)
-                        self.sendEmail(opponent, game, message)
-
-                        # return game over MoveResponse
-                        return MoveResponse(hit=True, ship=s.ship, sunk=True, message='Hit! Sunk! Game over! You win!')
-
-
-                    #return sunk ship message
-                    message = 'Your turn! {} sunk your {}!'.format(player.name, s.ship)
-                    self.sendEmail(opponent, game, message)
-
-                    return MoveResponse(hit=True, ship=s.ship, sunk=True, message="Hit! Sunk "+ s.ship + "!")
-
-                # hit message sent to opponent
-                message = 'Your turn! {} hit your {}!'.format(player.name, s.ship)
-                self.sendEmail(opponent, game, message)
-                # return hit message
-                return MoveResponse(hit=True, ship=s.ship, sunk=False, message="Hit on "+ s.ship + "!")
-
-        message = 'Your turn! {} missed at {}, {}!'.format(player.name, x, y)
-        self.sendEmail(opponent, game, message)
         # no match for a ship at x, y, so return a Miss message
         return MoveResponse(hit=False, message='Miss at '+ str(x) + ' , ' + str(y) +'!')
 
+    def _add_computer_move(self, response, x, y, shot):
+        ''' adds the computer's reply shot at x,y to response '''
+        response.computer_move = self._shot_results([((x, y), shot)])[0]
+        if shot.game_over:
+            text = 'The computer sunk your ' + shot.ship + '! Game over! You lose!'
+        elif shot.sunk:
+            text = 'The computer sunk your ' + shot.ship + '!'
+        elif shot.hit:
+            text = 'The computer hit your ' + shot.ship + ' at ' + str(x) + ' , ' + str(y) + '!'
+        else:
+            text = 'The computer missed at ' + str(x) + ' , ' + str(y) + '.'
+        response.message += ' ' + text
+
+    def _salvo_notices(self, player, opponent, shots):
+        ''' the (user, message) notifications for player's salvo '''
+        if shots[-1].game_over:
+            return self._move_notices(player, opponent, None, None, shots[-1])
+        message = 'Your turn! {} fired {} shots and hit {}!'.format(
+                player.name, len(shots), sum(1 for s in shots if s.hit))
+        sunk = [s.ship for s in shots if s.sunk]
+        if sunk:
+            message += ' They sunk your {}!'.format(', '.join(sunk))
+        return [(opponent, message)]
+
+    def _move_notices(self, player, opponent, x, y, shot):
+        ''' the (user, message) notifications for player's shot at x,y '''
+        if shot.game_over:
+            # game-over email goes to both players
+            message = '{} sunk {}! The game is over and {} won!'.format(player.name, shot.ship, player.name)
+            return [(player, message), (opponent, message)]
+        if shot.sunk:
+            message = 'Your turn! {} sunk your {}!'.format(player.name, shot.ship)
+        elif shot.hit:
+            message = 'Your turn! {} hit your {}!'.format(player.name, shot.ship)
+        else:
+            message = 'Your turn! {} missed at {}, {}!'.format(player.name, x, y)
+        return [(opponent, message)]
+
 
     @endpoints.method(request_message=GET_USER_GAMES,
                       response_message=MultiGamesMessage,
                       path='get_user_games/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_user_games(self, request):
-        ''' returns all games the specified user has in progress '''
-        user = User.by_name(request.user_name)
-        if not user:
+        ''' returns the games the specified user has in progress, oldest first,
+            one page at a time. pass next_cursor back as cursor for the next page '''
+        if not 0 < request.page_size <= 100:
+            raise endpoints.BadRequestException('page_size must be between 1 and 100.')
+        user_key = storage.user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException('User not found')
 
-        games = Game.query().filter(
-                    ndb.OR(Game.p1==user.key, Game.p2==user.key)).filter(
-                    Game.status != 'game over').fetch()
-
-        games.sort(key= lambda a: a.created)
+        try:
+            games, next_cursor = storage.active_games(user_key, request.page_size, request.cursor)
+        except InvalidCursor:
+            raise endpoints.BadRequestException('Invalid cursor')
 
+        names = storage.user_names([k for g in games for k in (g.p1, g.p2)])
         response = MultiGamesMessage(
-                        games=[game.to_form('') for game in games],
-                        user=request.user_name)
+                        games=[self._game_form(game, '', names) for game in games],
+                        user=request.user_name,
+                        next_cursor=next_cursor)
         return response
 
 
@@ -275,10 +632,12 @@ class BattleshipApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
+    @rate_limited
     def cancel_game(self, request):
         ''' cancel a game. This just deletes the game from the db. '''
 
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._get_game(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found')
 
@@ -287,74 +646,129 @@ class BattleshipApi(remote.Service):
                 'You can\'t delete a game that is already over')
 
         try:
-            game.delete_game()
+            storage.delete_game(game)
             return StringMessage(message='Game with id ' + request.urlsafe_game_key + 'successfully deleted.')
         except:
             raise endpoints.BadRequestException(
                 'An error was found in the request.')
 
 
-    @endpoints.method(response_message=GameRankings,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=GameRankings,
                       path='get_user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_user_rankings(self, request):
-        ''' returns user rankings, ordered by wins '''
-        games = Game.query(Game.status == 'game over').fetch()
-        users = User.query().fetch()
-        rankings = {u.key: {"name": u.name, "wins": 0} for u in users}
-        for g in games:
-            if g.winner in rankings.keys():
-                rankings[g.winner]["wins"] += 1
-        rankings = [RankLineItem(user_name=rankings[r]["name"], wins=rankings[r]["wins"]) for r in rankings]
-        rankings.sort(key= lambda u: int(u.get_assigned_value("wins"))*(-1))
-        return GameRankings(rankings=rankings)
+        ''' returns user rankings, ordered by wins, one page at a time.
+            pass next_cursor back as cursor to get the following page '''
+        if not 0 < request.page_size <= 100:
+            raise endpoints.BadRequestException('page_size must be between 1 and 100.')
+        try:
+            rankings, next_cursor = storage.rankings(request.page_size, request.cursor)
+        except InvalidCursor:
+            raise endpoints.BadRequestException('Invalid cursor')
+        return GameRankings(
+                rankings=[RankLineItem(user_name=name, wins=wins) for name, wins in rankings],
+                next_cursor=next_cursor)
 
 
 
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=STATS_REQUEST,
+                      response_message=StatsMessage,
+                      path='stats',
+                      name='get_stats',
+                      http_method='GET')
+    @instrumented
+    @rate_limited
+    def get_stats(self, request):
+        ''' statistics over all finished games (games finished, average moves
+            the winner needed), plus a user's games played, wins and hit ratio
+            if user_name is given. games are added shortly after they end '''
+        user_key = None
+        if request.user_name:
+            user_key = storage.user_key(request.user_name)
+            if not user_key:
+                raise endpoints.NotFoundException('User not found')
+        stats = storage.stats(user_key)
+        if user_key:
+            stats['user_name'] = request.user_name
+        return StatsMessage(**stats)
+
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=FullGameInfo,
                       path='game_history/{urlsafe_game_key}',
                       name='game_history',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_game_history(self, request):
-        ''' returns the usual GameForm, plus all related positions and all moves '''
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        ''' returns the usual GameForm, plus all related positions and all moves.
+            with since_seq, returns only the next page_size moves after that
+            sequence number, oldest first and without ships. pass the returned
+            seq back as since_seq to keep following the game '''
+        game = self._get_game(request.urlsafe_game_key)
         if not game:
-            return endpoints.NotFoundException("Game not found")
-        game_key = game.key
-        game = game.to_form("")
+            raise endpoints.NotFoundException("Game not found")
+        # every ship and move belongs to one of the two players
+        names = storage.user_names([game.p1, game.p2])
+        board = storage.board(game)
+        form = FullGameInfo(game=self._game_form(game, "", names))
+
+        if request.since_seq is None:
+            form.ships = self._history_ships(game, board, names)
+            form.moves = self._history_moves(game, board, names, 0, len(board.moves))[::-1]
+            form.seq = len(board.moves)
+            form.more = False
+            return form
+
+        if request.since_seq < 0 or not 0 < request.page_size <= MAX_HISTORY_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                    'since_seq must not be negative and page_size must be between 1 and {}.'.format(
+                            MAX_HISTORY_PAGE_SIZE))
+        start = min(request.since_seq, len(board.moves))
+        end = min(start + request.page_size, len(board.moves))
+        form.moves = self._history_moves(game, board, names, start, end)
+        form.seq = end
+        form.more = end < len(board.moves)
+        return form
 
-        ships = Ship.query(ancestor=game_key).order(-Ship.created).fetch()
+    def _history_ships(self, game, board, names):
+        ''' every placed ship with its positions, newest first. positions and
+            hits come from the board; placement dates come from the storage
+            backend where it keeps them '''
+        created = storage.ship_dates(game)
         ship_forms = []
-        for s in ships:
-            position_forms = []
-            positions = Position.query(ancestor=s.key).fetch()
-            for p in positions:
-                position_forms.append(XYMessage(x=p.x, y=p.y, hit=p.hit))
-            ship_forms.append(ShipMessage(
-                                player=s.player.get().name,
-                                ship=s.ship,
-                                created_date=s.created,
-                                positions=position_forms))
-
-        moves = Move.query(ancestor=game_key).order(-Move.created).fetch()
+        for player in (1, 2):
+            p_key = (game.p1, game.p2)[player - 1]
+            # the opponent's shots at this player decide which positions are hit
+            shots = board.shots[2 - player]
+            for ship, cells in sorted(board.fleets[player - 1].items()):
+                position_forms = []
+                for c in cells:
+                    x, y = cell_xy(c, board.size)
+                    position_forms.append(XYMessage(x=x, y=y, hit=c in shots))
+                ship_forms.append(ShipMessage(player=names.get(p_key),
+                                              ship=ship,
+                                              created_date=created.get((p_key, ship)),
+                                              positions=position_forms))
+        ship_forms.sort(key=lambda f: f.created_date, reverse=True)
+        return ship_forms
+
+    def _history_moves(self, game, board, names, start, end):
+        ''' MoveMessages for the board's move log entries start:end, in order '''
+        p_keys = (game.p1, game.p2)
         move_forms = []
-        for m in moves:
-            move_forms.append(MoveMessage(player=m.player.get().name, x=m.x, y=m.y, created_date=m.created))
-
-        form = FullGameInfo(game=game, ships=ship_forms, moves=move_forms)
-        return form
-
-
-
-    def sendEmail(self, user, game, message):
-        if user.email: # don't try to send emails to users who don't have that property
-            task = taskqueue.add(
-                    method='POST',
-                    url='/sendemail',
-                    params={'user_name': user.name, 'game_id': game.key.urlsafe(), 'user_email': user.email, 'message': message})
+        for seq in range(start, end):
+            m = board.moves[seq]
+            hit = cell(m.x, m.y, board.size) in board.occupied(3 - m.player)
+            move_forms.append(MoveMessage(player=names.get(p_keys[m.player - 1]),
+                                          x=m.x, y=m.y, hit=hit, seq=seq + 1,
+                                          created_date=m.created))
+        return move_forms
 
 
 api = endpoints.api_server([BattleshipApi])
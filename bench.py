@@ -0,0 +1,354 @@
+"""bench.py - Self-play load generator for the Battleship API.
+
+Plays complete games by calling the BattleshipApi methods directly, the way
+the endpoints server would: create_user, new_game, place_ship for every ship,
+make_move until one side has won, then get_user_games, get_user_rankings and
+get_game_history. The App Engine services run on the SDK's local stubs, so no
+dev_appserver or emulator is needed; with --backend memory the handlers also
+skip the datastore stub and run against storage.MemoryStorage.
+
+Each game's two players run in their own threads and place their ships at
+the same time, so setup contends on the game's entity group the way it does in
+production. --concurrency games are in flight at once, between --players users
+who each take part in many games.
+
+Reports games/sec, p50/p95/p99 latency per endpoint, conflicts and the
+datastore operations per game counted by instrumentation.py, and saves them
+as JSON for later runs to --compare against.
+
+    python bench.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --games 200 --concurrency 20 --players 50 --backend ndb \\
+        --compare bench_results/baseline.json"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(ROOT, 'bench_results')
+PERCENTILES = (50, 95, 99)
+DATASTORE_COUNTERS = ('datastore_get', 'datastore_query', 'datastore_put',
+                      'datastore_delete', 'datastore_commit')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Self-play load generator')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the google_appengine SDK directory (or set APPENGINE_SDK)')
+    parser.add_argument('--backend', choices=('ndb', 'memory'), default='ndb')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='games played at the same time')
+    parser.add_argument('--players', type=int, default=20,
+                        help='size of the user pool games are drawn from')
+    parser.add_argument('--compact', action='store_true',
+                        help='create compact games (no Ship/Position/Move entities)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep ratelimit.py on (its limits are far below a self-play run)')
+    parser.add_argument('--out', help='where to save the results (default bench_results/<backend>-<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    return parser.parse_args(argv)
+
+
+def setup_sdk(sdk):
+    ''' puts the SDK and its bundled libraries on sys.path '''
+    if sdk:
+        sys.path.insert(0, sdk)
+    try:
+        import dev_appserver
+    except ImportError:
+        sys.exit('The App Engine SDK was not found; pass --sdk or set APPENGINE_SDK.')
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def start_stubs():
+    ''' activates local stand-ins for every service the api uses '''
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    # fully consistent so the benchmark measures the handlers, not eventual consistency
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy, require_indexes=False)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+def percentile(values, p):
+    ''' nearest-rank percentile of a sorted list '''
+    if not values:
+        return None
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+class Recorder(object):
+    ''' latencies, errors and conflicts per endpoint, shared by every thread '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def call(self, name, method, request):
+        start = time.time()
+        try:
+            return method(request)
+        except Exception, e:
+            with self.lock:
+                self.errors[name][e.__class__.__name__] += 1
+            raise
+        finally:
+            ms = (time.time() - start) * 1000
+            with self.lock:
+                self.latencies[name].append(ms)
+
+    def summary(self):
+        result = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            result[name] = {'calls': len(values),
+                            'errors': dict(self.errors[name]),
+                            'mean_ms': round(sum(values) / len(values), 2)}
+            for p in PERCENTILES:
+                result[name]['p{}_ms'.format(p)] = round(percentile(values, p), 2)
+        return result
+
+
+class Player(threading.Thread):
+    ''' one side of one game: places its fleet, then takes its turns '''
+
+    def __init__(self, bench, game_key, user_name, number, other):
+        threading.Thread.__init__(self)
+        self.bench = bench
+        self.game_key = game_key
+        self.user_name = user_name
+        self.number = number
+        self.other = other
+        self.turn = threading.Event()
+        self.over = False
+        self.error = None
+        self.moves = 0
+
+    def run(self):
+        try:
+            self.place_fleet()
+            if self.number == 1:
+                self.turn.set()
+            self.play()
+        except Exception, e:
+            self.error = e
+            self.other.over = True
+            self.other.turn.set()
+
+    def retry(self, name, method, request):
+        ''' calls method, retrying while the game is busy '''
+        import endpoints
+        while True:
+            try:
+                return self.bench.recorder.call(name, method, request)
+            except endpoints.ConflictException:
+                with self.bench.recorder.lock:
+                    self.bench.conflicts[name] += 1
+
+    def place_fleet(self):
+        from board import random_fleet
+        import rules
+        api = self.bench.api
+        for ship, x, y, vertical in random_fleet(rules.SHIPS, rules.BOARD_SIZE):
+            request = api.NEW_POSITION_FORM.combined_message_class(
+                    urlsafe_game_key=self.game_key, user_name=self.user_name,
+                    ship=ship, x=x, y=y, vertical_orientation=vertical)
+            self.retry('place_ship', self.bench.service.place_ship, request)
+
+    def play(self):
+        import rules
+        api = self.bench.api
+        cells = [(x, y) for x in range(rules.BOARD_SIZE) for y in range(rules.BOARD_SIZE)]
+        self.bench.rng.shuffle(cells)
+        while True:
+            self.turn.wait()
+            self.turn.clear()
+            if self.over:
+                return
+            x, y = cells.pop()
+            request = api.MAKE_MOVE_REQUEST.combined_message_class(
+                    urlsafe_game_key=self.game_key, user_name=self.user_name, x=x, y=y)
+            response = self.retry('make_move', self.bench.service.make_move, request)
+            self.moves += 1
+            if 'Game over' in response.message:
+                self.over = self.other.over = True
+                self.other.turn.set()
+                self.bench.after_game(self.game_key, self.user_name)
+                return
+            self.other.turn.set()
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        import api
+        self.args = args
+        self.api = api
+        self.service = api.BattleshipApi()
+        self.recorder = Recorder()
+        self.conflicts = defaultdict(int)
+        self.rng = random.Random(args.seed)
+        self.users = ['bench-player-{}'.format(i) for i in range(args.players)]
+        self.next_game = 0
+        self.games_done = 0
+        self.moves = 0
+        self.failures = []
+
+    def create_users(self):
+        for name in self.users:
+            request = self.api.USER_REQUEST.combined_message_class(
+                    user_name=name, email=name + '@example.com')
+            self.recorder.call('create_user', self.service.create_user, request)
+
+    def play_game(self):
+        from models import NewGameForm
+        p1, p2 = self.rng.sample(self.users, 2)
+        game = self.recorder.call('new_game', self.service.new_game,
+                                  NewGameForm(player_1=p1, player_2=p2, compact=self.args.compact))
+        first = Player(self, game.urlsafe_key, p1, 1, None)
+        second = Player(self, game.urlsafe_key, p2, 2, first)
+        first.other = second
+        first.start()
+        second.start()
+        first.join()
+        second.join()
+        with self.recorder.lock:
+            self.moves += first.moves + second.moves
+            if first.error or second.error:
+                self.failures.append(repr(first.error or second.error))
+            else:
+                self.games_done += 1
+
+    def after_game(self, game_key, user_name):
+        ''' what a player looks at once a game is over '''
+        api = self.api
+        self.recorder.call('get_user_games', self.service.get_user_games,
+                           api.GET_USER_GAMES.combined_message_class(user_name=user_name))
+        self.recorder.call('get_user_rankings', self.service.get_user_rankings,
+                           api.RANKINGS_REQUEST.combined_message_class())
+        self.recorder.call('get_game_history', self.service.get_game_history,
+                           api.GAME_HISTORY_REQUEST.combined_message_class(urlsafe_game_key=game_key))
+
+    def table(self):
+        ''' one of the --concurrency threads, playing games until none are left '''
+        from google.appengine.ext import ndb
+        while True:
+            with self.recorder.lock:
+                if self.next_game >= self.args.games:
+                    return
+                self.next_game += 1
+            self.play_game()
+            ndb.get_context().clear_cache()
+
+    def run(self):
+        self.create_users()
+        start = time.time()
+        tables = [threading.Thread(target=self.table) for _ in range(self.args.concurrency)]
+        for t in tables:
+            t.start()
+        for t in tables:
+            t.join()
+        return time.time() - start
+
+    def results(self, elapsed):
+        import instrumentation
+        stats = instrumentation.stats()
+        ops = dict.fromkeys(DATASTORE_COUNTERS, 0)
+        for endpoint in stats.values():
+            for counter in DATASTORE_COUNTERS:
+                ops[counter] += endpoint[counter]
+        games = max(self.games_done, 1)
+        return {'config': {k: v for k, v in vars(self.args).items() if k not in ('sdk', 'out', 'compare')},
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - elapsed)),
+                'elapsed_s': round(elapsed, 3),
+                'games': self.games_done,
+                'failed_games': self.failures,
+                'games_per_sec': round(self.games_done / elapsed, 3),
+                'moves_per_game': round(self.moves / float(games), 1),
+                'conflicts': dict(self.conflicts),
+                'endpoints': self.recorder.summary(),
+                'datastore_ops_per_game': {k: round(v / float(games), 1) for k, v in ops.items()}}
+
+
+def report(results, baseline=None):
+    lines = ['{games} games in {elapsed_s}s: {games_per_sec} games/sec, '
+             '{moves_per_game} moves/game'.format(**results)]
+    if baseline:
+        lines[0] += ' (was {})'.format(baseline['games_per_sec'])
+    if results['failed_games']:
+        lines.append('{} games failed, first: {}'.format(len(results['failed_games']),
+                                                        results['failed_games'][0]))
+    lines.append('')
+    lines.append('{:<20}{:>8}{:>8}{:>10}{:>10}{:>10}'.format('endpoint', 'calls', 'errors',
+                                                            'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, e in sorted(results['endpoints'].items()):
+        line = '{:<20}{:>8}{:>8}{:>10}{:>10}{:>10}'.format(
+                name, e['calls'], sum(e['errors'].values()),
+                e['p50_ms'], e['p95_ms'], e['p99_ms'])
+        old = (baseline or {}).get('endpoints', {}).get(name)
+        if old:
+            line += '   p95 was {}'.format(old['p95_ms'])
+        lines.append(line)
+    lines.append('')
+    lines.append('conflicts retried: {}'.format(results['conflicts'] or 'none'))
+    lines.append('datastore ops per game:')
+    for counter, value in sorted(results['datastore_ops_per_game'].items()):
+        line = '  {:<20}{:>8}'.format(counter, value)
+        if baseline:
+            line += '   was {}'.format(baseline['datastore_ops_per_game'].get(counter))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv):
+    args = parse_args(argv)
+    setup_sdk(args.sdk)
+    bed = start_stubs()
+    try:
+        import ratelimit
+        ratelimit.ENABLED = args.rate_limit
+        bench = Bench(args)
+        if args.backend == 'memory':
+            from storage import MemoryStorage
+            bench.api.storage = MemoryStorage()
+        results = bench.results(bench.run())
+    finally:
+        bed.deactivate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print report(results, baseline)
+
+    out = args.out
+    if not out:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        out = os.path.join(RESULTS_DIR, '{}-{}.json'.format(
+                args.backend, time.strftime('%Y%m%d-%H%M%S')))
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print '\nresults saved to', out
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,309 @@
+"""board.py - Sparse representation of a game's fleets and shots.
+
+Every board cell has a number (cell = y * size + x). Each ship is stored as
+the tuple of its cells, each player has an index of which of their cells
+holds which ship, and the shots are a set of cells per player. Placing a ship,
+resolving a shot and saving a board then cost in proportion to the ships and
+shots, never to the area of the board, which can be up to MAX_SIZE cells
+wide. The board also carries its fleet (ship name -> length) when the game
+doesn't use the standard one from rules.py.
+
+The board also keeps the ordered move log, so a compact game can be stored
+and served entirely from the packed bytes on its Game entity."""
+
+import calendar
+import random
+import struct
+from collections import namedtuple
+from datetime import datetime
+
+
+# ships as lines, shots as cell lists, the game's fleet and the move log.
+# formats 1 and 2 (bitmasks) were never deployed and aren't read
+FORMAT_VERSION = 3
+
+# cells are packed in 16 bits
+MAX_SIZE = 100
+
+
+## Generic exception
+class GameException(Exception):
+    pass
+
+
+## result of a single shot
+Shot = namedtuple('Shot', ['hit', 'ship', 'sunk', 'game_over'])
+MISS = Shot(False, None, False, False)
+
+## one entry of the move log
+LoggedMove = namedtuple('LoggedMove', ['player', 'x', 'y', 'created'])
+
+
+def cell(x, y, size):
+    ''' number of the x,y coordinate '''
+    return y * size + x
+
+
+def cell_xy(c, size):
+    ''' x,y coordinate of cell number c '''
+    return c % size, c // size
+
+
+def on_board(x, y, size):
+    return 0 <= x < size and 0 <= y < size
+
+
+def ship_cells(x, y, length, vertical, size):
+    '''
+    returns the cells of a ship whose top-left-most point is x,y
+    or raises a GameException if any part of it is off the board
+    '''
+    if not on_board(x, y, size):
+        raise GameException('Requested position is off the board')
+    if (vertical and y + length > size) or (not vertical and x + length > size):
+        raise GameException('Not a valid position')
+    step = size if vertical else 1
+    start = cell(x, y, size)
+    return tuple(start + i * step for i in range(length))
+
+
+def ship_mask(x, y, length, vertical, size):
+    ''' ship_cells as a bitmask with bit c set for each cell c '''
+    return cells_mask(ship_cells(x, y, length, vertical, size))
+
+
+def cells_mask(cells):
+    mask = 0
+    for c in cells:
+        mask |= 1 << c
+    return mask
+
+
+def mask_cells(mask):
+    ''' the cells of the bits set in mask, the inverse of cells_mask '''
+    return [c for c in range(mask.bit_length()) if mask >> c & 1]
+
+
+def pack_cells(cells, size):
+    ''' cells as a (size * size + 7) // 8 byte bitmap, cell 0 in the least
+        significant bit of the first byte '''
+    packed = bytearray((size * size + 7) // 8)
+    for c in cells:
+        packed[c >> 3] |= 1 << (c & 7)
+    return str(packed)
+
+
+def placements(length, size):
+    ''' every legal (x, y, vertical, mask) for a ship of length on the board.
+        there are about 2 * size * size of them, so this is for small boards '''
+    table = []
+    for vertical in (False, True):
+        for y in range(size - length + 1 if vertical else size):
+            for x in range(size if vertical else size - length + 1):
+                table.append((x, y, vertical, ship_mask(x, y, length, vertical, size)))
+    return table
+
+
+def random_fleet(ships, size, occupied=(), rng=random, attempts=100, restarts=100):
+    '''
+    picks a random non-overlapping placement for every ship in ships, a dict
+    of name -> length, avoiding the cells in occupied. returns a list of
+    (ship_name, x, y, vertical).
+
+    the longest ships go first. each one draws an orientation and then a
+    position where it fits on the board, which is a uniform draw from its
+    legal placements, and rejects it if it overlaps the ships placed so far;
+    if a ship cannot be fitted the fleet starts over
+    '''
+    names = sorted(ships, key=lambda n: -ships[n])
+    for _ in range(restarts):
+        taken = set()
+        fleet = []
+        for name in names:
+            length = ships[name]
+            for _ in range(attempts):
+                vertical = rng.random() < 0.5
+                x = rng.randrange(size if vertical else size - length + 1)
+                y = rng.randrange(size - length + 1 if vertical else size)
+                cells = ship_cells(x, y, length, vertical, size)
+                if not any(c in taken or c in occupied for c in cells):
+                    break
+            else:
+                break
+            taken.update(cells)
+            fleet.append((name, x, y, vertical))
+        else:
+            return fleet
+    raise GameException('No room left to place the remaining ships')
+
+
+def _pack_str(s):
+    b = s.encode('utf-8')
+    return struct.pack('>B', len(b)) + b
+
+
+def _unpack_str(data, offset):
+    (length,) = struct.unpack_from('>B', data, offset)
+    offset += 1
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+class Board(object):
+    '''
+    both players' fleets and shots for one game. players are numbered 1 and 2
+    like everywhere else in the api.
+
+    ships maps ship name -> length for the game's fleet, or is None for the
+    standard fleet (rules.SHIPS)
+    fleets[i] maps ship name -> tuple of cells for player i+1
+    owners[i] maps each of player i+1's ship cells -> ship name
+    shots[i] is the set of cells player i+1 has fired at on the opponent's board
+    moves is the list of LoggedMove in the order they were made; a move's
+    1-based position in it is its sequence number
+    '''
+
+    def __init__(self, size, ships=None):
+        self.size = size
+        self.ships = ships
+        self.fleets = ({}, {})
+        self.owners = ({}, {})
+        self.shots = [set(), set()]
+        self.moves = []
+        # ship cells of each player not hit yet
+        self._afloat = [0, 0]
+
+    def occupied(self, player):
+        ''' every cell covered by one of player's ships, as a cell -> ship name dict '''
+        return self.owners[player - 1]
+
+    def place(self, player, ship_name, x, y, length, vertical=False):
+        ''' adds a ship to player's fleet and returns its cells. raises
+            GameException if it does not fit '''
+        if ship_name in self.fleets[player - 1]:
+            raise GameException('Ship already placed')
+        cells = ship_cells(x, y, length, vertical, self.size)
+        if any(c in self.owners[player - 1] for c in cells):
+            raise GameException('Position already occupied')
+        self.add_ship(player, ship_name, cells)
+        return cells
+
+    def add_ship(self, player, ship_name, cells):
+        ''' adds a ship at cells without checking them '''
+        cells = tuple(sorted(cells))
+        self.fleets[player - 1][ship_name] = cells
+        owners = self.owners[player - 1]
+        shots = self.shots[2 - player]
+        for c in cells:
+            owners[c] = ship_name
+            if c not in shots:
+                self._afloat[player - 1] += 1
+
+    def remaining_ships(self, player, ships):
+        ''' names in ships that player has not placed yet '''
+        return [name for name in ships if name not in self.fleets[player - 1]]
+
+    def has_shot(self, player, x, y):
+        return cell(x, y, self.size) in self.shots[player - 1]
+
+    def hits(self, player):
+        ''' the cells of player's ships the opponent has hit '''
+        owners = self.owners[player - 1]
+        return [c for c in self.shots[2 - player] if c in owners]
+
+    def misses(self, player):
+        ''' the opponent's shots at player that missed '''
+        owners = self.owners[player - 1]
+        return [c for c in self.shots[2 - player] if c not in owners]
+
+    def is_sunk(self, player, ship_name):
+        shots = self.shots[2 - player]
+        return all(c in shots for c in self.fleets[player - 1][ship_name])
+
+    def fire(self, player, x, y, created=None):
+        '''
+        records player's shot at x,y on the opponent's board and returns a
+        Shot(hit, ship, sunk, game_over)
+        '''
+        if not on_board(x, y, self.size):
+            raise GameException('Attempted move is off the board.')
+        c = cell(x, y, self.size)
+        shots = self.shots[player - 1]
+        repeat = c in shots
+        shots.add(c)
+        self.moves.append(LoggedMove(player, x, y, created or datetime.utcnow()))
+        opponent = 3 - player
+        name = self.owners[opponent - 1].get(c)
+        if name is None:
+            return MISS
+        if not repeat:
+            self._afloat[opponent - 1] -= 1
+        sunk = self.is_sunk(opponent, name)
+        return Shot(True, name, sunk, sunk and not self._afloat[opponent - 1])
+
+    def clear_shots(self):
+        ''' forgets every shot and the move log, e.g. to replay them '''
+        self.shots = [set(), set()]
+        self.moves = []
+        self._afloat = [len(self.owners[0]), len(self.owners[1])]
+
+    def to_bytes(self):
+        out = [struct.pack('>BHB', FORMAT_VERSION, self.size, len(self.ships or ()))]
+        for name in sorted(self.ships or ()):
+            out.append(_pack_str(name))
+            out.append(struct.pack('>B', self.ships[name]))
+        for i in range(2):
+            fleet = self.fleets[i]
+            out.append(struct.pack('>B', len(fleet)))
+            for name in sorted(fleet):
+                cells = fleet[name]
+                vertical = len(cells) > 1 and cells[1] - cells[0] == self.size
+                out.append(_pack_str(name))
+                out.append(struct.pack('>HBB', cells[0], len(cells), vertical))
+            shots = sorted(self.shots[i])
+            out.append(struct.pack('>H%dH' % len(shots), len(shots), *shots))
+        out.append(struct.pack('>H', len(self.moves)))
+        for m in self.moves:
+            out.append(struct.pack('>BHI', m.player, cell(m.x, m.y, self.size),
+                                   calendar.timegm(m.created.utctimetuple())))
+        return ''.join(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, size = struct.unpack_from('>BH', data, 0)
+        if version != FORMAT_VERSION:
+            raise ValueError('Unknown board format %d' % version)
+        board = cls(size)
+        offset = 3
+        (count,) = struct.unpack_from('>B', data, offset)
+        offset += 1
+        ships = {}
+        for _ in range(count):
+            name, offset = _unpack_str(data, offset)
+            (ships[name],) = struct.unpack_from('>B', data, offset)
+            offset += 1
+        board.ships = ships or None
+        for i in range(2):
+            (count,) = struct.unpack_from('>B', data, offset)
+            offset += 1
+            for _ in range(count):
+                name, offset = _unpack_str(data, offset)
+                start, length, vertical = struct.unpack_from('>HBB', data, offset)
+                offset += 4
+                step = size if vertical else 1
+                board.fleets[i][name] = tuple(start + j * step for j in range(length))
+            (count,) = struct.unpack_from('>H', data, offset)
+            board.shots[i] = set(struct.unpack_from('>%dH' % count, data, offset + 2))
+            offset += 2 + 2 * count
+        for i in range(2):
+            for name, cells in board.fleets[i].items():
+                for c in cells:
+                    board.owners[i][c] = name
+            board._afloat[i] = sum(1 for c in board.owners[i] if c not in board.shots[1 - i])
+        (count,) = struct.unpack_from('>H', data, offset)
+        offset += 2
+        for _ in range(count):
+            player, c, ts = struct.unpack_from('>BHI', data, offset)
+            offset += 7
+            board.moves.append(LoggedMove(player, c % size, c // size,
+                                          datetime.utcfromtimestamp(ts)))
+        return board
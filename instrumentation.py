@@ -0,0 +1,108 @@
+"""instrumentation.py - Per-endpoint RPC counts and latency histograms.
+
+Decorate an endpoint method with @instrumented (below @endpoints.method).
+While it runs, an apiproxy hook counts the datastore, memcache and taskqueue
+RPCs made by the request's thread. When it finishes, the counts, an error
+flag and a latency bucket are added to memcache counters for that endpoint
+with one offset_multi. stats() reads them back for the /admin/stats
+handler. Set LOG_REQUESTS to also log one JSON line per request."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map, memcache
+
+
+LOG_REQUESTS = False
+
+# upper bounds in milliseconds; slower requests land in 'inf'
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+COUNTERS = ('datastore_get', 'datastore_query', 'datastore_put',
+            'datastore_delete', 'datastore_commit', 'memcache_hit',
+            'memcache_miss', 'taskqueue_add')
+
+# names of every instrumented endpoint, filled in at import time
+ENDPOINTS = []
+
+_DATASTORE_CALLS = {'Get': 'datastore_get', 'RunQuery': 'datastore_query',
+                    'Put': 'datastore_put', 'Delete': 'datastore_delete',
+                    'Commit': 'datastore_commit'}
+
+_local = threading.local()
+
+
+def _count_rpc(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3' and call in _DATASTORE_CALLS:
+        counts[_DATASTORE_CALLS[call]] += 1
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['memcache_hit'] += hits
+        counts['memcache_miss'] += request.key_size() - hits
+    elif service == 'taskqueue' and call == 'Add':
+        counts['taskqueue_add'] += 1
+    elif service == 'taskqueue' and call == 'BulkAdd':
+        counts['taskqueue_add'] += request.add_request_size()
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrumentation', _count_rpc)
+
+
+def _bucket(ms):
+    for limit in LATENCY_BUCKETS:
+        if ms <= limit:
+            return 'le_{}'.format(limit)
+    return 'inf'
+
+
+def instrumented(func):
+    ''' counts RPCs and records latency for every call of an endpoint method '''
+    name = func.__name__
+    ENDPOINTS.append(name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.counts = dict.fromkeys(COUNTERS, 0)
+        start = time.time()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            counts, _local.counts = _local.counts, None
+            ms = (time.time() - start) * 1000
+            _record(name, counts, ms, failed)
+    return wrapper
+
+
+def _record(name, counts, ms, failed):
+    deltas = dict(counts)
+    deltas['calls'] = 1
+    deltas['errors'] = int(failed)
+    deltas['latency:' + _bucket(ms)] = 1
+    try:
+        memcache.offset_multi(deltas, key_prefix='stats:{}:'.format(name), initial_value=0)
+    except Exception:
+        logging.exception('Could not record stats for %s', name)
+    if LOG_REQUESTS:
+        line = dict(counts, endpoint=name, latency_ms=round(ms, 1), error=failed)
+        logging.info('request_stats %s', json.dumps(line, sort_keys=True))
+
+
+def stats():
+    ''' returns {endpoint: {counter: total, 'latency_ms': {bucket: count}}} '''
+    buckets = ['latency:le_{}'.format(b) for b in LATENCY_BUCKETS] + ['latency:inf']
+    fields = ['calls', 'errors'] + list(COUNTERS) + buckets
+    result = {}
+    for name in ENDPOINTS:
+        values = memcache.get_multi(fields, key_prefix='stats:{}:'.format(name))
+        endpoint = {f: values.get(f, 0) for f in fields if not f.startswith('latency:')}
+        endpoint['latency_ms'] = {b[len('latency:'):]: values.get(b, 0) for b in buckets}
+        result[name] = endpoint
+    return result
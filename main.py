@@ -2,15 +2,28 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
 import webapp2
+from datetime import datetime
 from google.appengine.api import mail, app_identity
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import BattleshipApi
+import instrumentation
+import ratelimit
+import notifications
+from utils import transaction_stats
 
-from models import User, Game
+from models import User, UserName, Game, Ranking, WinCounterShard, RANKINGS_CACHE_KEY
+from models import SentReminder, DELETE_BATCH, add_game_stats, reminder_key
 
 
 class SendEmail(webapp2.RequestHandler):
+    ''' one mail per task. moves now go through notifications.py; this only
+        drains tasks queued before that '''
     def post(self):
         user_name = self.request.get('user_name')
         user_email = self.request.get('user_email')
@@ -28,33 +41,278 @@ class SendEmail(webapp2.RequestHandler):
                        subject,
                        body)
 
+class SendDigests(webapp2.RequestHandler):
+    def post(self):
+        notifications.send_digests()
+
+
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
+        ''' starts today's reminder run; the work is done by RemindBatch.
+            earlier runs' SentReminder markers are deleted by ForgetReminders '''
+        run = datetime.utcnow().date().isoformat()
+        _add_once(taskqueue.Task(url='/tasks/remind_batch',
+                                 name='remind-{}-0'.format(run),
+                                 params={'run': run, 'batch': 0}))
+        taskqueue.add(url='/tasks/forget_reminders', params={'run': run})
+
+
+class RemindBatch(webapp2.RequestHandler):
+    BATCH_SIZE = 200
+
+    def post(self):
+        ''' maps over one page of active games with a projection query, works
+            out whose turn it is in each, resolves those users' emails with one
+            get_multi and hands the reminders to a SendReminders task.
+            the send task and the next batch are named after the run and
+            batch number, so a retried batch cannot enqueue either twice '''
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(Game.active == True).fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor,
+                projection=[Game.status, Game.p1, Game.p2])
+
+        turns = [(g.p1 if g.status == 'p1 move' else g.p2, g.key)
+                 for g in games if g.status in ('p1 move', 'p2 move')]
+        user_keys = list(set(user_key for user_key, _ in turns))
+        users = dict(zip(user_keys, ndb.get_multi(user_keys)))
+        reminders = [(users[user_key].email, game_key.urlsafe())
+                     for user_key, game_key in turns
+                     if users[user_key] and users[user_key].email]
 
+        if reminders:
+            _add_once(taskqueue.Task(url='/tasks/send_reminders',
+                                     name='reminders-{}-{}'.format(run, batch),
+                                     payload=json.dumps({'run': run, 'reminders': reminders})))
+        if more and next_cursor:
+            _add_once(taskqueue.Task(url='/tasks/remind_batch',
+                                     name='remind-{}-{}'.format(run, batch + 1),
+                                     params={'run': run, 'batch': batch + 1,
+                                             'cursor': next_cursor.urlsafe()}))
+        logging.info('Reminder run %s batch %d: %d reminders', run, batch, len(reminders))
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        ''' sends one batch of reminders. each sent reminder is recorded as a
+            SentReminder for the run, so a retry of a partly sent batch skips
+            the ones already sent '''
+        data = json.loads(self.request.body)
+        run = data['run']
         app_id = app_identity.get_application_id()
-        open_games = Game.query(Game.status.IN(['p1 move','p2 move'])).fetch()
-
-        emails_to_send = []
-        for g in open_games:
-            if g.status == 'p1 move':
-                user_email = g.p1.get().email
-            elif g.status == 'p2 move':
-                user_email = g.p2.get().email
-            if user_email:
-                emails_to_send.append((user_email, g.key.urlsafe()))
-
-        for e in emails_to_send:
+        keys = [reminder_key(run, game_key) for _, game_key in data['reminders']]
+        sent = ndb.get_multi(keys)
+
+        for (user_email, game_key), key, marker in zip(data['reminders'], keys, sent):
+            if marker:
+                continue
             subject = 'Your turn!'
-            body = 'Just a reminder: It\'s your turn in the Battleship game with id {}!'.format(e[1])
+            body = 'Just a reminder: It\'s your turn in the Battleship game with id {}!'.format(game_key)
 
             # from, to, subject, body
             mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           e[0],
+                           user_email,
                            subject,
                            body)
+            SentReminder(key=key, run=run).put()
+
+
+class ForgetReminders(webapp2.RequestHandler):
+    def post(self):
+        ''' deletes one batch of the SentReminder markers of runs before run,
+            then re-queues itself until they are all gone '''
+        run = self.request.get('run')
+        keys = SentReminder.query(SentReminder.run < run).fetch(
+                DELETE_BATCH, keys_only=True)
+        ndb.delete_multi(keys)
+        if len(keys) == DELETE_BATCH:
+            taskqueue.add(url='/tasks/forget_reminders', params={'run': run})
+
+
+def _add_once(task):
+    ''' adds a named task, ignoring it if it was already added '''
+    try:
+        taskqueue.Queue().add(task)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class MigrateCompactGames(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
+    def post(self):
+        ''' folds one batch of entity-tree games into compact games, then
+            re-queues itself from the cursor until every game is migrated '''
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor)
+        migrated = 0
+        for g in games:
+            if not g.compact:
+                g.migrate_to_compact()
+                migrated += 1
+        logging.info('Migrated %d of %d games to compact storage', migrated, len(games))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_compact',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class DeleteGameChildren(webapp2.RequestHandler):
+    def post(self):
+        ''' deletes the children left behind by a cancelled or compacted
+            game, one batch per task, see Game.delete_tree '''
+        key = ndb.Key(urlsafe=self.request.get('game_key'))
+        if Game.delete_children(key):
+            taskqueue.add(url='/tasks/delete_children',
+                          params={'game_key': key.urlsafe()})
+
+
+class CompactFinishedGames(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
+    def get(self):
+        ''' cron: starts a compaction run over the finished games '''
+        taskqueue.add(url='/tasks/compact_finished')
+
+    def post(self):
+        ''' folds one batch of finished entity-tree games into their boards
+            (see Game.migrate_to_compact), then re-queues itself from the
+            cursor. games already compact aren't fetched at all '''
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+                Game.active == False, Game.compact == False).fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor)
+        for g in games:
+            g.migrate_to_compact()
+        logging.info('Compacted %d finished games', len(games))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/compact_finished',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class CacheAverageAttempts(webapp2.RequestHandler):
+    def post(self):
+        ''' adds a game that just ended to the statistics '''
+        add_game_stats(ndb.Key(urlsafe=self.request.get('game_key')))
+
+
+class RebuildStats(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
+    def post(self):
+        ''' streams the finished games in cursor batches and adds each one
+            the statistics are missing (finished before they existed, or
+            whose task failed), then re-queues itself from the cursor '''
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query(Game.active == False).fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        added = sum(1 for key in keys if add_game_stats(key))
+        logging.info('Added %d of %d finished games to the statistics', added, len(keys))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rebuild_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class ResaveGames(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    def post(self):
+        ''' re-puts every game, one batch per task, so computed properties
+            added since a game was last written (participants, active,
+            compact) are stored and indexed '''
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(games)
+        logging.info('Resaved %d games', len(games))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/resave_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class IndexUserNames(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    def post(self):
+        ''' adds every user to the UserName index, one batch per task, so
+            users created before it existed can be found by name '''
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor)
+        added = UserName.index_users(users)
+        logging.info('Indexed %d of %d users', added, len(users))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/index_user_names',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class UpdateRanking(webapp2.RequestHandler):
+    def post(self):
+        ''' refreshes one user's Ranking after a win was counted '''
+        Ranking.refresh(ndb.Key(urlsafe=self.request.get('user_key')))
+
+
+class RebuildRankings(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
+    def post(self):
+        ''' one-time backfill: recounts each user's wins from their finished
+            games into shard 0 of their counter and their Ranking, one batch
+            of users per task '''
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor)
+        for u in users:
+            wins = Game.query(Game.winner == u.key).count()
+            shard_keys = WinCounterShard.shard_keys(u.key)
+            ndb.delete_multi(shard_keys[1:])
+            ndb.put_multi([WinCounterShard(key=shard_keys[0], count=wins),
+                           Ranking(id=u.key.id(), name=u.name, wins=wins)])
+        logging.info('Rebuilt rankings for %d users', len(users))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rebuild_rankings',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            memcache.delete(RANKINGS_CACHE_KEY)
+
+
+class AdminStats(webapp2.RequestHandler):
+    def get(self):
+        ''' per-endpoint RPC counts and latency histograms (see
+            instrumentation.py), transaction retry counters and rate limiter
+            admissions and denials (see ratelimit.py), as JSON '''
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+                'endpoints': instrumentation.stats(),
+                'transactions': {name: transaction_stats(name)
+                                 for name in ('make_move', 'make_salvo')},
+                'rate_limits': ratelimit.stats(instrumentation.ENDPOINTS)},
+                indent=2, sort_keys=True))
 
 
 app = webapp2.WSGIApplication([
     ('/sendemail', SendEmail),
-    ('/crons/send_reminder', SendReminderEmail)
+    ('/tasks/send_digests', SendDigests),
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/remind_batch', RemindBatch),
+    ('/tasks/send_reminders', SendReminders),
+    ('/tasks/forget_reminders', ForgetReminders),
+    ('/tasks/migrate_compact', MigrateCompactGames),
+    ('/tasks/delete_children', DeleteGameChildren),
+    ('/crons/compact_finished', CompactFinishedGames),
+    ('/tasks/compact_finished', CompactFinishedGames),
+    ('/tasks/cache_average_attempts', CacheAverageAttempts),
+    ('/tasks/rebuild_stats', RebuildStats),
+    ('/tasks/resave_games', ResaveGames),
+    ('/tasks/index_user_names', IndexUserNames),
+    ('/tasks/update_ranking', UpdateRanking),
+    ('/tasks/rebuild_rankings', RebuildRankings),
+    ('/admin/stats', AdminStats)
 ], debug=True)
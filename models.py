@@ -1,19 +1,30 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the Game. Because these classes are also regular Python
-classes they can include methods (such as 'to_form' and 'new_game')."""
+classes they can include methods (such as 'new_game'). The rules of the game
+are in rules.py and the writes made for them in ndb_storage.py."""
 
+import calendar
 import random
-from datetime import date
+from datetime import datetime
 from protorpc import messages, message_types
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
+from utils import LRUCache
+from board import Board, cell
+import rules
+from rules import BOARD_SIZE
 ## Constants
-SHIPS = {'Destroyer': 2, 'Cruiser': 3, 'Submarine': 3, 'Battleship': 4, 'Aircraft Carrier': 5}
-BOARD_SIZE = 10
-
-## Generic exception
-class GameException(Exception):
-    pass
-
+WIN_SHARDS = 5
+RANKINGS_PAGE_SIZE = 20
+USER_GAMES_PAGE_SIZE = 20
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+RANKINGS_CACHE_KEY = 'rankings:top'
+STATS_SHARDS = 5
+# most children deleted with a game in one transaction; a task deletes the rest
+DELETE_BATCH = 400
 
 ## MODELS
 class User(ndb.Model):
@@ -23,32 +34,310 @@ class User(ndb.Model):
     created = ndb.DateTimeProperty(required=True, auto_now_add=True)
 
     @classmethod
-    def by_name(cls, name):
-        return User.query(User.name == name).get()
+    @ndb.tasklet
+    def by_name_async(cls, name):
+        key = yield cls.key_for_name_async(name)
+        user = (yield key.get_async()) if key else None
+        raise ndb.Return(user)
+
+    @classmethod
+    def key_for_name(cls, name):
+        return cls.key_for_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def key_for_name_async(cls, name):
+        '''
+        resolves a user name to its key through the in-process cache, then
+        memcache, then a get of the UserName index entity. users created
+        before the index existed are indexed by /tasks/index_user_names.
+        unknown names are not cached, since they can be created at any time
+        '''
+        if not name:
+            raise ndb.Return(None)
+        key = _user_keys.get(name)
+        if key:
+            raise ndb.Return(key)
+        ctx = ndb.get_context()
+        cache_key = _user_key_cache_key(name)
+        urlsafe = yield ctx.memcache_get(cache_key)
+        if urlsafe:
+            key = ndb.Key(urlsafe=urlsafe)
+        else:
+            index = yield UserName.get_by_id_async(name)
+            if not index:
+                raise ndb.Return(None)
+            key = index.user
+            yield ctx.memcache_set(cache_key, key.urlsafe())
+        _user_keys.set(name, key)
+        raise ndb.Return(key)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def create(cls, name, email=None):
+        ''' creates a user, or returns None if the name is already taken '''
+        if UserName.get_by_id(name):
+            return None
+        user = cls(name=name, email=email)
+        user.put()
+        ndb.put_multi([UserName(id=name, user=user.key),
+                       Ranking(id=user.key.id(), name=name)])
+        return user
+
+    @classmethod
+    def names_for(cls, keys):
+        '''
+        returns a dict of user key -> name for keys. names already in the
+        in-process cache are used as is; the rest are resolved with one
+        get_multi (which goes through ndb's own cache)
+        '''
+        names = {}
+        missing = []
+        for key in set(keys):
+            name = _user_names.get(key)
+            if name is None:
+                missing.append(key)
+            else:
+                names[key] = name
+        for key, user in zip(missing, ndb.get_multi(missing)):
+            if user:
+                names[key] = user.name
+                _user_names.set(key, user.name)
+        return names
+
+
+class UserName(ndb.Model):
+    ''' unique index of user names. the entity id is the name '''
+    user = ndb.KeyProperty(required=True, kind='User')
+
+    @classmethod
+    def index_users(cls, users):
+        ''' adds the users missing from the index, e.g. users created before
+            it existed. a name already indexed keeps its user. returns how
+            many were added '''
+        keys = [ndb.Key(cls, u.name) for u in users]
+        missing = [cls(key=k, user=u.key)
+                   for k, u, index in zip(keys, users, ndb.get_multi(keys)) if not index]
+        ndb.put_multi(missing)
+        return len(missing)
+
+
+def _version_cache_key(game_key):
+    return 'game_version:' + game_key.urlsafe()
+
+
+def _publish_version(game_key, version, attempts=5):
+    '''
+    raises the game's version in memcache to version. commits can publish
+    in any order, so an older version never replaces a newer one: the value
+    is only ever added or compare-and-set upwards. if memcache stays
+    contended the key is dropped and the next reader reloads it
+    '''
+    client = memcache.Client()
+    cache_key = _version_cache_key(game_key)
+    for _ in range(attempts):
+        cached = client.gets(cache_key)
+        if cached is None:
+            if client.add(cache_key, version):
+                return
+        elif cached >= version or client.cas(cache_key, version):
+            return
+    client.delete(cache_key)
+
+
+# name -> User key and back; a user's name never changes so these never go stale
+_user_keys = LRUCache(10000)
+_user_names = LRUCache(10000)
+
+
+def _user_key_cache_key(name):
+    return 'user_key:' + name.encode('utf-8')
+
+
+class WinCounterShard(ndb.Model):
+    ''' one shard of a user's win count. ids are '<user id>:<shard>'.
+        wins are spread over WIN_SHARDS entity groups so finishing games never
+        contend on a single counter '''
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls, user_key):
+        return [ndb.Key(cls, '{}:{}'.format(user_key.id(), i)) for i in range(WIN_SHARDS)]
+
+    @classmethod
+    def add_win(cls, user_key):
+        ''' adds a win to a random shard and returns the shard for the caller
+            to put. must run inside the transaction that ends the game; the
+            user's Ranking is refreshed by a task once it commits '''
+        key = random.choice(cls.shard_keys(user_key))
+        shard = key.get() or cls(key=key)
+        shard.count += 1
+        taskqueue.add(url='/tasks/update_ranking',
+                      params={'user_key': user_key.urlsafe()},
+                      transactional=True)
+        return shard
+
+    @classmethod
+    def total(cls, user_key):
+        return sum(s.count for s in ndb.get_multi(cls.shard_keys(user_key)) if s)
+
+
+class Ranking(ndb.Model):
+    ''' a user's total wins, summed from their WinCounterShards so the
+        leaderboard is one ordered query. the id is the user's id '''
+    name = ndb.StringProperty(required=True)
+    wins = ndb.IntegerProperty(required=True, default=0)
+
+    @classmethod
+    def refresh(cls, user_key):
+        '''
+        recomputes a user's Ranking from their shards. the shards are read in
+        the same xg transaction (WIN_SHARDS + 1 entity groups) as the put, so
+        a refresh that read them before a later win commits is retried rather
+        than writing its older total over a newer one
+        '''
+        user = user_key.get()
+        if not user:
+            return
+
+        @ndb.transactional(xg=True)
+        def txn():
+            cls(id=user_key.id(), name=user.name, wins=WinCounterShard.total(user_key)).put()
+        txn()
+        memcache.delete(RANKINGS_CACHE_KEY)
+
+    @classmethod
+    def page(cls, page_size=RANKINGS_PAGE_SIZE, urlsafe_cursor=None):
+        '''
+        returns ([(name, wins)], next urlsafe cursor or None) ordered by wins.
+        the first page at the default size is cached in memcache until a
+        Ranking changes
+        '''
+        cacheable = not urlsafe_cursor and page_size == RANKINGS_PAGE_SIZE
+        if cacheable:
+            cached = memcache.get(RANKINGS_CACHE_KEY)
+            if cached is not None:
+                return cached
+        rankings, cursor, more = cls.query().order(-cls.wins).fetch_page(
+                page_size, start_cursor=Cursor(urlsafe=urlsafe_cursor))
+        result = ([(r.name, r.wins) for r in rankings],
+                  cursor.urlsafe() if more and cursor else None)
+        if cacheable:
+            memcache.set(RANKINGS_CACHE_KEY, result)
+        return result
+
+
+class StatsShard(ndb.Model):
+    ''' one shard of the statistics over all finished games. ids are 0 to
+        STATS_SHARDS - 1 '''
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    winning_moves = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class UserStats(ndb.Model):
+    ''' a user's statistics over their finished games. the id is the user's id '''
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    shots = ndb.IntegerProperty(default=0, indexed=False)
+    hits = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class CountedGame(ndb.Model):
+    ''' marks a finished game as added to the statistics. a root entity whose
+        id is the game's urlsafe key, so it outlives the game's children
+        being deleted by migrate_to_compact '''
+
+
+class SentReminder(ndb.Model):
+    ''' marks a reminder as sent. the id is the reminder run (its date) and
+        the game's urlsafe key, see reminder_key '''
+    run = ndb.StringProperty(required=True)
+
+
+def reminder_key(run, game_key):
+    ''' the key of run's SentReminder for the game with urlsafe key game_key '''
+    return ndb.Key(SentReminder, '{}:{}'.format(run, game_key))
+
+
+def _stats_cache_key(user_key=None):
+    return 'game_stats:' + ('user:{}'.format(user_key.id()) if user_key else 'all')
+
+
+def add_game_stats(game_key):
+    '''
+    adds a finished game to StatsShard and both players' UserStats, working
+    from the game's board so no Move is read. runs in one transaction with a
+    CountedGame marker, so a retried task or a game reached again by
+    rebuild_stats is only ever counted once. returns whether it was added
+    '''
+    @ndb.transactional(xg=True)
+    def txn():
+        marker = ndb.Key(CountedGame, game_key.urlsafe())
+        game, counted = ndb.get_multi([game_key, marker])
+        if not game or game.status != 'game over' or counted:
+            return None
+        game.get_board()
+        players = rules.final_stats(game)
+        users = ndb.get_multi([ndb.Key(UserStats, k.id()) for k, _, _, _ in players])
+        shard_key = ndb.Key(StatsShard, random.randrange(STATS_SHARDS))
+        shard = shard_key.get() or StatsShard(key=shard_key)
+        shard.games += 1
+        to_put = [CountedGame(key=marker), shard]
+        for (user_key, shots, hits, won), stats in zip(players, users):
+            stats = stats or UserStats(id=user_key.id())
+            stats.games += 1
+            stats.shots += shots
+            stats.hits += hits
+            if won:
+                stats.wins += 1
+                shard.winning_moves += shots
+            to_put.append(stats)
+        ndb.put_multi(to_put)
+        return [k for k, _, _, _ in players]
+
+    user_keys = txn()
+    if user_keys is None:
+        return False
+    memcache.delete_multi([_stats_cache_key()] + [_stats_cache_key(k) for k in user_keys])
+    return True
+
+
+def game_stats(user_key=None):
+    ''' the statistics over all finished games, plus user_key's own if given,
+        as a dict. each part is cached in memcache until a game is added '''
+    result = memcache.get(_stats_cache_key())
+    if result is None:
+        shards = [s for s in ndb.get_multi([ndb.Key(StatsShard, i) for i in range(STATS_SHARDS)]) if s]
+        games = sum(s.games for s in shards)
+        result = {'games_finished': games,
+                  'average_moves_to_win': sum(s.winning_moves for s in shards) / float(games) if games else None}
+        memcache.set(_stats_cache_key(), result)
+    result = dict(result)
+    if user_key:
+        user = memcache.get(_stats_cache_key(user_key))
+        if user is None:
+            stats = ndb.Key(UserStats, user_key.id()).get() or UserStats()
+            user = {'games_played': stats.games,
+                    'wins': stats.wins,
+                    'hit_ratio': stats.hits / float(stats.shots) if stats.shots else None}
+            memcache.set(_stats_cache_key(user_key), user)
+        result.update(user)
+    return result
 
 
 class Move(ndb.Model):
-    ''' x,y coordinate that player wishes to shoot at on opponent's board'''
+    ''' x,y coordinate that player wishes to shoot at on opponent's board
+        history log only: the game itself is played from Game.board '''
     player = ndb.KeyProperty(required=True, kind="User")
     x = ndb.IntegerProperty(required=True)
     y = ndb.IntegerProperty(required=True)
     created = ndb.DateTimeProperty(auto_now_add=True)
 
-    @classmethod
-    def get_move(cls, game, player, x, y):
-        ''' see if move already exists. returns None if it doesn't'''
-        q = cls.query(
-            cls.player==player.key,
-            cls.x==x,
-            cls.y==y,
-            ancestor=game.key)
-        move = q.get()
-        return move
-
 
 class Ship(ndb.Model):
     ''' one of player's ships. parent of position
-        if all Ship's child Positions are hit, sunk is set to True
+        hit/sunk state lives in Game.board; sunk is only set on games that
+        predate it
     '''
     player = ndb.KeyProperty(required=True, kind="User")
     ship = ndb.StringProperty(required=True) # name of ship
@@ -60,6 +349,7 @@ class Ship(ndb.Model):
 class Position(ndb.Model):
     ''' coordinates of the parent ship. each Ship coordinate gets its own Position
         Boolean hit is whether or not the player's opponent has shot that part of the ship
+        (only maintained on games that predate Game.board)
     '''
     x = ndb.IntegerProperty(required=True)
     y = ndb.IntegerProperty(required=True)
@@ -67,115 +357,201 @@ class Position(ndb.Model):
     created = ndb.DateTimeProperty(auto_now_add=True)
 
 
+class BoardProperty(ndb.BlobProperty):
+    ''' stores a board.Board packed into a blob '''
+    def _validate(self, value):
+        if not isinstance(value, Board):
+            raise TypeError('Expected a Board, got %r' % (value,))
+
+    def _to_base_type(self, value):
+        return value.to_bytes()
+
+    def _from_base_type(self, value):
+        return Board.from_bytes(value)
+
+
 class Game(ndb.Model):
     """
        Game object.
        statuses: 'setting up', 'p1 move', 'p2 move', 'game over'
+       board holds both fleets, all shots and the move log, and the board
+       size and fleet chosen at new_game; see board.py
+       compact games keep everything in board and have no Ship, Position
+       or Move children. salvo is the number of shots per turn.
+       archive keeps what else game_history shows from
+       those children (when each ship was placed) once they are folded in
+       participants and active are kept up to date on every put and back
+       the (participants, active, created) index used by get_user_games
+       version goes up by one on every put and is mirrored in memcache so
+       pollers can check for changes without reading the entity
     """
     status = ndb.StringProperty(required=True, default='setting up')
     p1 = ndb.KeyProperty(required=True, kind='User')
     p2 = ndb.KeyProperty(required=True, kind='User')
     winner = ndb.KeyProperty(kind='User')
+    board = BoardProperty()
+    compact = ndb.BooleanProperty(default=False)
+    salvo = ndb.IntegerProperty(default=1, indexed=False)
+    archive = ndb.JsonProperty(compressed=True)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    participants = ndb.ComputedProperty(lambda self: [self.p1, self.p2], repeated=True)
+    active = ndb.ComputedProperty(lambda self: self.status != 'game over')
     created = ndb.DateTimeProperty(auto_now_add=True)
     modified = ndb.DateTimeProperty(auto_now=True)
 
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    def _post_put_hook(self, future):
+        key, version = self.key, self.version
+        # only publish the version once it is actually committed
+        ndb.get_context().call_on_commit(lambda: _publish_version(key, version))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        memcache.delete(_version_cache_key(key))
+
+    @classmethod
+    def current_version(cls, key):
+        ''' the game's version from memcache, falling back to the datastore.
+            None if the game does not exist '''
+        version = memcache.get(_version_cache_key(key))
+        if version is None:
+            game = key.get()
+            if not game:
+                return None
+            version = game.version
+            memcache.add(_version_cache_key(key), version)
+        return version
+
     @classmethod
-    def new_game(cls, user1, user2):
+    def active_for(cls, user_key, page_size, urlsafe_cursor=None):
+        ''' returns (games, next urlsafe cursor or None) for one page of the
+            user's unfinished games, oldest first '''
+        games, cursor, more = cls.query(
+                cls.participants == user_key, cls.active == True).order(
+                cls.created).fetch_page(page_size, start_cursor=Cursor(urlsafe=urlsafe_cursor))
+        return games, cursor.urlsafe() if more and cursor else None
+
+    @classmethod
+    def new_game(cls, user1, user2, compact=False, salvo=1, size=BOARD_SIZE, ships=None):
         """Creates and returns a new game"""
         game = Game(p1=user1,
-                    p2=user2)
+                    p2=user2,
+                    board=Board(size, ships),
+                    compact=compact,
+                    salvo=salvo)
         game.put()
         return game
 
-    def delete_game(self):
-        self.key.delete()
-
-    ## gets all of a player's ships in the game
-    def get_ships(self, user_key):
-        return Ship.query(ancestor=self.key).filter(Ship.player==user_key).fetch()
+    def player_num(self, user_key):
+        return rules.player_num(self, user_key)
 
-    ##  returns which ships are not yet on each player's board during game setup
-    def remaining_ships_to_setup(self):
-        ships = SHIPS.keys()
-        p1_positions = [s.ship for s in self.get_ships(self.p1)]
-        p2_positions = [s.ship for s in self.get_ships(self.p2)]
-        return ([ship for ship in ships if ship not in p1_positions],
-                [ship for ship in ships if ship not in p2_positions])
+    def get_board(self):
+        return self.get_board_async().get_result()
 
-    @ndb.transactional(xg=True)
-    def add_ship(self, player, ship_name, x, y, vertical=False):
+    @ndb.tasklet
+    def get_board_async(self):
         '''
-        adds a ship to the board at the given coordinates for the given player
-        or returns a GameException if the move turns out to be invalid
-
-        using the @ndb.transactional decorator because you have to create
-        a ship to start generating positions... but you might want to undo
-        everything if a position turns out to be invalid
+        returns the game's Board. games created before the board existed have
+        it rebuilt once from their Ship, Position and Move entities, which are
+        queried concurrently; it is saved the next time the game is put
         '''
+        if self.board is None:
+            ships, positions, moves = yield (
+                    Ship.query(ancestor=self.key).fetch_async(),
+                    Position.query(ancestor=self.key).fetch_async(),
+                    Move.query(ancestor=self.key).order(Move.created).fetch_async())
+            board = Board(BOARD_SIZE)
+            ships = {s.key: s for s in ships}
+            cells = {}
+            for p in positions:
+                cells.setdefault(p.key.parent(), []).append(cell(p.x, p.y, BOARD_SIZE))
+            for key, ship_cells in cells.items():
+                s = ships[key]
+                board.add_ship(self.player_num(s.player), s.ship, ship_cells)
+            self.board = board
+            self._replay_moves(moves)
+        raise ndb.Return(self.board)
+
+    def _replay_moves(self, moves):
+        ''' rebuilds the board's shots and move log from Move entities '''
+        board = self.board
+        board.clear_shots()
+        for m in moves:
+            board.fire(self.player_num(m.player), m.x, m.y, m.created)
+
+    def child_keys(self, limit=None):
+        ''' keys of every Ship, Position and Move under this game, or the
+            first limit of them '''
+        keys = ndb.Query(ancestor=self.key).fetch(
+                None if limit is None else limit + 1, keys_only=True)
+        return [k for k in keys if k != self.key][:limit]
+
+    @ndb.transactional
+    def delete_tree(self):
+        '''
+        deletes the game and its Ship, Position and Move children, found with
+        a keys-only ancestor query. the game goes in the same delete_multi as
+        up to DELETE_BATCH children; if there are more, a task started in the
+        same transaction deletes the rest, see delete_children
+        '''
+        keys = self.child_keys(DELETE_BATCH + 1)
+        ndb.delete_multi([self.key] + keys[:DELETE_BATCH])
+        if len(keys) > DELETE_BATCH:
+            taskqueue.add(url='/tasks/delete_children',
+                          params={'game_key': self.key.urlsafe()},
+                          transactional=True)
 
-        game = self
+    @classmethod
+    def delete_children(cls, key):
+        ''' deletes one batch of the children left under a deleted or
+            compacted game. returns whether there may be more '''
+        keys = ndb.Query(ancestor=key).fetch(DELETE_BATCH + 1, keys_only=True)
+        # a compacted game is still there, see migrate_to_compact
+        keys = [k for k in keys if k != key][:DELETE_BATCH]
+        ndb.delete_multi(keys)
+        return len(keys) == DELETE_BATCH
+
+    def archived_ship_dates(self):
+        ''' {(user key, ship name): date placed} saved in archive '''
+        players = (self.p1, self.p2)
+        return {(players[p - 1], ship): datetime.utcfromtimestamp(ts)
+                for p, ship, ts in (self.archive or {}).get('ship_dates', [])}
+
+    @ndb.transactional
+    def migrate_to_compact(self):
+        '''
+        folds an entity-tree game into its board and deletes the children.
+        the board already holds the move log (get_board replays it from the
+        Move entities for games saved before the board existed); the ships'
+        placement dates go into archive. up to DELETE_BATCH children are
+        deleted in the same transaction and a task deletes the rest, as in
+        delete_tree. returns the migrated game
+        '''
+        game = self.key.get()
+        if game.compact:
+            return game
+        game.get_board()
+        ships = Ship.query(ancestor=game.key).fetch()
+        game.archive = {'ship_dates': [
+                [game.player_num(s.player), s.ship, calendar.timegm(s.created.utctimetuple())]
+                for s in ships]}
+        game.compact = True
+        game.put()
+        keys = game.child_keys(DELETE_BATCH + 1)
+        ndb.delete_multi(keys[:DELETE_BATCH])
+        if len(keys) > DELETE_BATCH:
+            taskqueue.add(url='/tasks/delete_children',
+                          params={'game_key': game.key.urlsafe()},
+                          transactional=True)
+        return game
 
-        if y not in range(BOARD_SIZE) or x not in range(BOARD_SIZE):
-            raise GameException("Requested position is off the board")
 
-        # figure out which player is placing a ship
-        if player == 1:
-            p_key = self.p1
-        else:
-            p_key = self.p2
-
-        # create the ship
-        ship = Ship(parent=self.key, player=p_key, ship=ship_name)
-        ship.put()
-
-        # get previous ships to check for conflicts.
-        old_ships = Ship.query(ancestor=self.key).fetch()
-        board = []
-        for s in old_ships:
-            if s.player == p_key: # must check user this way to use transactions
-                positions = Position.query(ancestor=s.key).fetch()
-                board.extend(positions)
-        print board
-        board_coords = [(p.x, p.y) for p in board]
-
-        #create the x,y pairs representing where the ship is on the board
-        ship_len = SHIPS[ship_name]
-        print ship_len
-        x_init = x
-        y_init = y
-        coordinates = []
-        if not vertical:
-            while x < x_init+ship_len:
-                print x
-                if x >= BOARD_SIZE:
-                    raise GameException('Not a valid position')
-                if (x, y) in board_coords:
-                    raise GameException('Position already occupied')
-                coord = Position(parent=ship.key, x=x, y=y)
-                coordinates.append(coord)
-                x += 1
-        else:
-            while y < y_init+ship_len:
-                if y >= BOARD_SIZE:
-                    raise GameException('Not a valid position')
-                if (x, y) in board_coords:
-                    raise GameException('Position already occupied')
-                coord = Position(parent=ship.key, x=x, y=y)
-                coordinates.append(coord)
-                y += 1
-
-        ndb.put_multi(coordinates)
-
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
-        form = GameForm()
-        form.urlsafe_key = self.key.urlsafe()
-        form.p1 = self.p1.get().name
-        form.p2 = self.p2.get().name
-        form.status = self.status
-        form.message = message
-        form.created_date = self.created
-        return form
+class ShipSpecMessage(messages.Message):
+    """One ship of a game's fleet"""
+    name = messages.StringField(1, required=True)
+    length = messages.IntegerField(2, required=True)
 
 
 class GameForm(messages.Message):
@@ -186,22 +562,95 @@ class GameForm(messages.Message):
     p1 = messages.StringField(4, required=True)
     p2 = messages.StringField(5, required=True)
     created_date = message_types.DateTimeField(6, required=True)
+    version = messages.IntegerField(7)
+    salvo = messages.IntegerField(8)
+    board_size = messages.IntegerField(9)
+    ships = messages.MessageField(ShipSpecMessage, 10, repeated=True)
+
+
+class BoardLayersMessage(messages.Message):
+    ''' one player's board. each layer is a bitmask of the board's cells
+        (see board.pack_cells), base64 encoded on the wire. ships is left
+        out of the opponent's board in a mine_only view '''
+    player = messages.IntegerField(1, required=True)
+    ships = messages.BytesField(2)
+    hits = messages.BytesField(3, required=True)
+    misses = messages.BytesField(4, required=True)
+
+
+class BoardResponse(messages.Message):
+    """Outbound packed board state. boards is only set if the version changed"""
+    version = messages.IntegerField(1, required=True)
+    changed = messages.BooleanField(2, required=True)
+    size = messages.IntegerField(3)
+    status = messages.StringField(4)
+    boards = messages.MessageField(BoardLayersMessage, 5, repeated=True)
+
+
+class GamePollResponse(messages.Message):
+    """Outbound answer to poll_game. game is only set if the version changed"""
+    version = messages.IntegerField(1, required=True)
+    changed = messages.BooleanField(2, required=True)
+    game = messages.MessageField(GameForm, 3)
 
 
 class PositionForm(messages.Message):
-    ''' inbound form for creating a ship position '''
+    ''' inbound form for creating a ship position
+        ship, x and y are required unless auto_place is set, in which case
+        all of the user's remaining ships are placed at random '''
     urlsafe_game_key = messages.StringField(1, required=True)
     user_name = messages.StringField(2, required=True)
-    ship = messages.StringField(3, required=True)
-    x = messages.IntegerField(4, required=True)
-    y = messages.IntegerField(5, required=True)
+    ship = messages.StringField(3)
+    x = messages.IntegerField(4)
+    y = messages.IntegerField(5)
     vertical_orientation = messages.BooleanField(6, required=True, default=False)
+    auto_place = messages.BooleanField(7, default=False)
+
+
+class ShipPlacementForm(messages.Message):
+    ''' one ship of an inbound fleet placement '''
+    ship = messages.StringField(1, required=True)
+    x = messages.IntegerField(2, required=True)
+    y = messages.IntegerField(3, required=True)
+    vertical_orientation = messages.BooleanField(4, default=False)
+
+
+class FleetForm(messages.Message):
+    ''' inbound form for placing several of a player's ships at once '''
+    user_name = messages.StringField(1, required=True)
+    ships = messages.MessageField(ShipPlacementForm, 2, repeated=True)
+
+
+class ShipErrorMessage(messages.Message):
+    ship = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+
+
+class FleetResponse(messages.Message):
+    ''' game state after a fleet placement, or why each rejected ship failed '''
+    game = messages.MessageField(GameForm, 1, required=True)
+    errors = messages.MessageField(ShipErrorMessage, 2, repeated=True)
+
+
+class AutoPlace(messages.Enum):
+    ''' whose fleets new_game places at random '''
+    NONE = 0
+    PLAYER_1 = 1
+    PLAYER_2 = 2
+    BOTH = 3
 
 
 class NewGameForm(messages.Message):
-    """Used to create a new game"""
+    """Used to create a new game. Without player_2, player_1 plays the computer.
+       salvo is the number of shots each player fires per turn. board_size
+       and ships default to the standard 10x10 board and five ships"""
     player_1 = messages.StringField(1, required=True)
     player_2 = messages.StringField(2)
+    compact = messages.BooleanField(3, default=False)
+    auto_place = messages.EnumField(AutoPlace, 4, default=AutoPlace.NONE)
+    salvo = messages.IntegerField(5, default=1)
+    board_size = messages.IntegerField(6, default=BOARD_SIZE)
+    ships = messages.MessageField(ShipSpecMessage, 7, repeated=True)
 
 
 class MakeMoveForm(messages.Message):
@@ -211,11 +660,41 @@ class MakeMoveForm(messages.Message):
     user_name = messages.StringField(3, required=True)
 
 
+class ShotResultMessage(messages.Message):
+    ''' the result of one shot '''
+    x = messages.IntegerField(1, required=True)
+    y = messages.IntegerField(2, required=True)
+    hit = messages.BooleanField(3, required=True)
+    ship = messages.StringField(4)
+    sunk = messages.BooleanField(5)
+
+
 class MoveResponse(messages.Message):
     hit = messages.BooleanField(1, required=True)
     ship = messages.StringField(2)
     sunk = messages.BooleanField(3)
     message = messages.StringField(4)
+    computer_move = messages.MessageField(ShotResultMessage, 5)
+
+
+class ShotForm(messages.Message):
+    x = messages.IntegerField(1, required=True)
+    y = messages.IntegerField(2, required=True)
+
+
+class SalvoForm(messages.Message):
+    """Used to fire all of a turn's shots in a salvo game"""
+    user_name = messages.StringField(1, required=True)
+    shots = messages.MessageField(ShotForm, 2, repeated=True)
+
+
+class SalvoResponse(messages.Message):
+    ''' the result of each shot of a salvo, in the order they were fired,
+        and of the computer's reply salvo in a single-player game '''
+    results = messages.MessageField(ShotResultMessage, 1, repeated=True)
+    game_over = messages.BooleanField(2, required=True)
+    message = messages.StringField(3)
+    computer_shots = messages.MessageField(ShotResultMessage, 4, repeated=True)
 
 
 class StringMessage(messages.Message):
@@ -226,6 +705,17 @@ class StringMessage(messages.Message):
 class MultiGamesMessage(messages.Message):
     user = messages.StringField(1)
     games = messages.MessageField(GameForm, 2, repeated=True)
+    next_cursor = messages.StringField(3)
+
+
+class StatsMessage(messages.Message):
+    """Outbound game statistics. The user fields are only set for a user_name"""
+    games_finished = messages.IntegerField(1, required=True)
+    average_moves_to_win = messages.FloatField(2)
+    user_name = messages.StringField(3)
+    games_played = messages.IntegerField(4)
+    wins = messages.IntegerField(5)
+    hit_ratio = messages.FloatField(6)
 
 
 class RankLineItem(messages.Message):
@@ -235,6 +725,7 @@ class RankLineItem(messages.Message):
 
 class GameRankings(messages.Message):
     rankings = messages.MessageField(RankLineItem, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class XYMessage(messages.Message):
@@ -255,9 +746,15 @@ class MoveMessage(messages.Message):
     x = messages.IntegerField(2)
     y = messages.IntegerField(3)
     created_date = message_types.DateTimeField(4)
+    hit = messages.BooleanField(5)
+    seq = messages.IntegerField(6)
 
 
 class FullGameInfo(messages.Message):
+    ''' seq is the sequence number of the last move covered by this response;
+        more is set when there are later moves than the page returned '''
     game = messages.MessageField(GameForm, 1)
     ships = messages.MessageField(ShipMessage, 2, repeated=True)
     moves = messages.MessageField(MoveMessage, 3, repeated=True)
+    seq = messages.IntegerField(4)
+    more = messages.BooleanField(5)
@@ -0,0 +1,166 @@
+"""ndb_storage.py - The App Engine implementation of storage.Storage.
+
+Games and users are the NDB entities in models.py and keys are ndb.Keys.
+update_game runs inside one cross-group transaction: the game is re-read,
+changed by the caller and written together with the records it produced in a
+single put_multi. Entity-tree games also get their Ship/Position entities in
+that put and a Move entity after the commit; compact games only write the
+Game."""
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+import endpoints
+
+from models import User, Game, Ship, Position, Move, Ranking, WinCounterShard
+from models import game_stats
+from board import GameException, cell_xy
+from storage import Storage, InvalidId, InvalidCursor, Contention
+from utils import key_from_urlsafe, record_transaction
+import notifications
+import rules
+
+
+TXN_RETRIES = 3
+
+
+class NdbStorage(Storage):
+
+    def user_by_name_async(self, name):
+        return User.by_name_async(name)
+
+    def user_key(self, name):
+        return User.key_for_name(name)
+
+    def get_user_async(self, user_key):
+        return user_key.get_async()
+
+    def create_user(self, name, email=None):
+        return User.create(name, email)
+
+    def user_names(self, user_keys):
+        return User.names_for(user_keys)
+
+    def new_game(self, p1, p2, compact=False, salvo=1, size=rules.BOARD_SIZE, ships=None):
+        compact = compact or not rules.is_standard(size, ships)
+        return Game.new_game(p1, p2, compact, salvo, size, ships)
+
+    def game_id(self, game):
+        return game.key.urlsafe()
+
+    def _key(self, game_id):
+        try:
+            key = key_from_urlsafe(game_id)
+        except endpoints.BadRequestException:
+            raise InvalidId(game_id)
+        if key.kind() != Game._get_kind():
+            raise InvalidId(game_id)
+        return key
+
+    def get_game_async(self, game_id):
+        return self._key(game_id).get_async()
+
+    def game_version(self, game_id):
+        return Game.current_version(self._key(game_id))
+
+    def board(self, game):
+        return game.get_board()
+
+    def update_game(self, game, fn, name=None):
+        '''
+        attempts and retries are counted under name, see
+        utils.record_transaction. callers should run under ndb.toplevel so
+        the Move entities put after the commit get flushed
+        '''
+        attempts = []
+
+        def txn():
+            attempts.append(1)
+            current = game.key.get()
+            if not current:
+                raise GameException('Game not found!')
+            current.get_board()
+            result, records = fn(current)
+            if records is not None:
+                self._write(current, records)
+            return current, result, records
+
+        failed = False
+        try:
+            current, result, records = ndb.transaction(txn, xg=True, retries=TXN_RETRIES)
+        except datastore_errors.TransactionFailedError:
+            failed = True
+            raise Contention()
+        finally:
+            if name:
+                record_transaction(name, len(attempts), failed)
+
+        if records is not None:
+            game.board = current.board
+            game.status = current.status
+            game.winner = current.winner
+            game.version = current.version
+            if not game.compact:
+                for record in records:
+                    if record[0] == rules.MOVE:
+                        Move(parent=game.key, player=record[1], x=record[2], y=record[3]).put_async()
+        return result
+
+    def _write(self, game, records):
+        ''' puts game with the entities its records call for. notifications
+            are enqueued as part of the transaction, overlapped with the put '''
+        to_put = [game]
+        rpcs = []
+        for record in records:
+            if record[0] == rules.SHIP and not game.compact:
+                to_put.extend(self._ship_entities(game, *record[1:]))
+            elif record[0] == rules.WIN:
+                to_put.append(WinCounterShard.add_win(record[1]))
+                taskqueue.add(url='/tasks/cache_average_attempts',
+                              params={'game_key': game.key.urlsafe()},
+                              transactional=True)
+            elif record[0] == rules.NOTIFY:
+                rpcs.extend(notifications.queue_async(record[1], game.key, transactional=True))
+        ndb.put_multi(to_put)
+        notifications.wait(rpcs)
+
+    def _ship_entities(self, game, player, ship_name, cells):
+        '''
+        the Ship and Position entities kept for game history of entity-tree
+        games. the ship id is derived from player and ship name (each is only
+        placed once per game), so the Positions can be built without first
+        putting the Ship
+        '''
+        p_key = game.p1 if player == 1 else game.p2
+        ship = Ship(id='p{}:{}'.format(player, ship_name), parent=game.key,
+                    player=p_key, ship=ship_name)
+        return [ship] + [Position(parent=ship.key, x=px, y=py)
+                         for px, py in (cell_xy(c, game.board.size) for c in cells)]
+
+    def delete_game(self, game):
+        game.delete_tree()
+
+    def ship_dates(self, game):
+        ''' a single query for entity-tree games; compact games only have the
+            dates archived when they were migrated '''
+        if game.compact:
+            return game.archived_ship_dates()
+        return {(s.player, s.ship): s.created
+                for s in Ship.query(ancestor=game.key).fetch()}
+
+    def active_games(self, user_key, page_size, cursor=None):
+        try:
+            return Game.active_for(user_key, page_size, cursor)
+        except datastore_errors.BadValueError:
+            raise InvalidCursor(cursor)
+
+    def rankings(self, page_size, cursor=None):
+        try:
+            return Ranking.page(page_size, cursor)
+        except datastore_errors.BadValueError:
+            raise InvalidCursor(cursor)
+
+    def stats(self, user_key=None):
+        ''' from memcache; finished games are added by a task, see
+            models.add_game_stats '''
+        return game_stats(user_key)
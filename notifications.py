@@ -0,0 +1,89 @@
+"""notifications.py - Coalesced email notifications.
+
+Requests never send mail or wait on a push task. Each notification is a task
+on the 'notifications' pull queue, tagged with the recipient's user id, and
+is enqueued inside the transaction that caused it. A named push task per
+WINDOW seconds runs send_digests, which leases the queued notifications one
+user at a time and sends each user a single digest for everything that
+happened to them in that window."""
+
+import json
+import logging
+import time
+from google.appengine.api import app_identity, mail, taskqueue
+
+
+QUEUE = 'notifications'
+WINDOW = 60
+LEASE_SECONDS = 60
+MAX_LEASE = 100
+# how long one send_digests run keeps leasing before handing over to a new task
+RUN_SECONDS = 8 * 60
+
+
+def queue_async(notices, game_key, transactional=False):
+    '''
+    starts enqueueing a notification for each (user, message) in notices
+    (users without an email are skipped) and makes sure this window's
+    digest run is scheduled. returns the rpcs to pass to wait()
+    '''
+    tasks = [taskqueue.Task(method='PULL',
+                            tag=str(user.key.id()),
+                            payload=json.dumps({'user_name': user.name,
+                                                'user_email': user.email,
+                                                'game_key': game_key.urlsafe(),
+                                                'message': message}))
+             for user, message in notices if user.email]
+    if not tasks:
+        return []
+    window = int(time.time()) // WINDOW
+    flush = taskqueue.Task(url='/tasks/send_digests',
+                           name='digests-{}'.format(window),
+                           countdown=WINDOW)
+    # named tasks can't be transactional; a duplicate flush just finds nothing to send
+    return [taskqueue.Queue(QUEUE).add_async(tasks, transactional=transactional),
+            taskqueue.Queue().add_async(flush)]
+
+
+def wait(rpcs):
+    ''' waits for queue_async's rpcs. the digest run being scheduled already
+        is expected and ignored '''
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+def send_digests():
+    '''
+    leases queued notifications one user (tag) at a time and sends each user
+    one digest email, until the queue is empty. if it runs out of time,
+    another run is queued to carry on
+    '''
+    queue = taskqueue.Queue(QUEUE)
+    sender = 'noreply@{}.appspotmail.com'.format(app_identity.get_application_id())
+    deadline = time.time() + RUN_SECONDS
+    sent = 0
+    while time.time() < deadline:
+        # with no tag given, leases tasks sharing the oldest task's tag
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, MAX_LEASE)
+        if not tasks:
+            break
+        notices = [json.loads(t.payload) for t in tasks]
+        mail.send_mail(sender, notices[0]['user_email'], 'Your turn!', _digest_body(notices))
+        queue.delete_tasks(tasks)
+        sent += 1
+    else:
+        taskqueue.add(url='/tasks/send_digests')
+    logging.info('Sent %d notification digests', sent)
+
+
+def _digest_body(notices):
+    lines = [u'Hello {}, you have news about your Battleship games!'.format(notices[0]['user_name'])]
+    for n in notices:
+        lines.append(u'')
+        lines.append(u'Game {}: {}'.format(n['game_key'], n['message']))
+    lines.append(u'')
+    lines.append(u'Good luck!')
+    return u'\n'.join(lines)
@@ -0,0 +1,185 @@
+"""ratelimit.py - Admission control for the api's endpoints.
+
+Decorate an endpoint method with @rate_limited (below @instrumented). Every
+call takes a token from a bucket for the request's user (user_name, or
+player_1 for new_game), one for its urlsafe_game_key and one for the
+client's address, for whichever of those its endpoint has limits, and is
+rejected with a retry-after hint once any of its buckets is empty. LIMITS
+sets each endpoint's refill rate and burst per bucket.
+
+Buckets live in memcache as a sliding window: a counter per window of
+burst / rate seconds, taken with an atomic increment. A call is admitted
+while its count plus the previous window's count, weighted by how much of
+that window still overlaps the last burst / rate seconds, is within burst,
+which holds a client to rate calls a second with bursts of up to burst. All
+of a call's buckets, the previous windows and the limiter's own counters go
+in one offset_multi, so an admitted call costs one memcache RPC. A refused
+call gives its tokens back to every bucket, so it costs the client nothing;
+two calls racing for a bucket's last token may then both be refused. A
+refused bucket is also remembered in process until its retry-after, so a
+client that keeps retrying is turned away without any RPC. If memcache is
+unavailable, calls are admitted."""
+
+import functools
+import hashlib
+import threading
+import time
+from collections import defaultdict
+import endpoints
+from google.appengine.api import memcache
+from utils import LRUCache
+
+
+ENABLED = True
+
+# endpoint -> {'user', 'game' or 'client': (tokens per second, burst)}
+DEFAULT_LIMITS = {'user': (5, 20), 'game': (10, 40)}
+LIMITS = {
+    'make_move': {'user': (2, 10), 'game': (4, 20)},
+    'make_salvo': {'user': (2, 10), 'game': (4, 20)},
+    'get_game': {'user': (5, 20), 'game': (5, 20)},
+    'poll_game': {'game': (5, 20)},
+    'get_board': {'user': (5, 20), 'game': (5, 20)},
+    'new_game': {'user': (1, 10)},
+    # the name is new on every call, so only the caller's address can be limited
+    'create_user': {'client': (1, 5)},
+}
+# request fields holding each scope's id, first one set wins
+_FIELDS = (('user', ('user_name', 'player_1')), ('game', ('urlsafe_game_key',)))
+
+# (endpoint, scope, id) -> time until which the bucket is known to be empty
+_denied = LRUCache(10000)
+# counters waiting to ride along with this instance's next offset_multi
+_pending = defaultdict(int)
+_pending_lock = threading.Lock()
+
+
+class RateLimitExceeded(endpoints.ServiceException):
+    http_status = 429
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super(RateLimitExceeded, self).__init__(
+                'Too many requests, retry after {:.1f} seconds.'.format(retry_after))
+
+
+def _stats_key(name, counter):
+    return 'ratelimit:{}:{}'.format(name, counter)
+
+
+def _bucket_key(name, scope, value, window):
+    value = value.encode('utf-8') if isinstance(value, unicode) else value
+    if len(value) > 150:
+        value = hashlib.sha1(value).hexdigest()
+    return 'bucket:{}:{}:{}:{}'.format(name, scope, value, window)
+
+
+def _wait(previous, current, elapsed, period, burst):
+    '''
+    seconds until one more call fits in a bucket whose previous and current
+    windows hold previous and current calls, elapsed seconds into the
+    current window, if no other calls come. the previous window's weight
+    falls to zero by the end of the current one, and the current window
+    then becomes the previous one
+    '''
+    if current + 1 <= burst:
+        return period * (1 - (burst - current - 1) / float(previous)) - elapsed
+    return period - elapsed + period * (1 - (burst - 1) / float(current))
+
+
+def _count_later(name, counter):
+    with _pending_lock:
+        _pending[_stats_key(name, counter)] += 1
+
+
+def _scope_ids(request, client):
+    ''' yields (scope, id) for each scope the request has an id for '''
+    for scope, fields in _FIELDS:
+        for field in fields:
+            value = getattr(request, field, None)
+            if value:
+                yield scope, value
+                break
+    if client:
+        yield 'client', client
+
+
+def check(name, request, client=None):
+    ''' takes a token from each of request's buckets for endpoint name, or
+        raises RateLimitExceeded. client is the caller's address '''
+    limits = LIMITS.get(name, DEFAULT_LIMITS)
+    buckets = [(scope, value) for scope, value in _scope_ids(request, client)
+               if scope in limits]
+    if not buckets:
+        return
+    now = time.time()
+
+    for scope, value in buckets:
+        until = _denied.get((name, scope, value))
+        if until and until > now:
+            _count_later(name, 'denied')
+            raise RateLimitExceeded(until - now)
+
+    keys = {}
+    deltas = {}
+    for scope, value in buckets:
+        rate, burst = limits[scope]
+        period = burst / float(rate)
+        window = int(now // period)
+        key = _bucket_key(name, scope, value, window)
+        previous = _bucket_key(name, scope, value, window - 1)
+        keys[key] = (scope, value, previous, burst, now - window * period, period)
+        deltas[key] = 1
+        deltas[previous] = 0
+    with _pending_lock:
+        for key, n in _pending.items():
+            deltas[key] = deltas.get(key, 0) + n
+        _pending.clear()
+    checked = _stats_key(name, 'checked')
+    deltas[checked] = deltas.get(checked, 0) + 1
+    try:
+        counts = memcache.offset_multi(deltas, initial_value=0)
+    except Exception:
+        counts = {}
+
+    retry_after = 0
+    for key, (scope, value, previous, burst, elapsed, period) in keys.items():
+        current, before = counts.get(key), counts.get(previous) or 0
+        if current is None or before * (1 - elapsed / period) + current <= burst:
+            continue
+        wait = _wait(before, current - 1, elapsed, period, burst)
+        _denied.set((name, scope, value), now + wait)
+        retry_after = max(retry_after, wait)
+    if retry_after:
+        try:
+            memcache.offset_multi(dict.fromkeys(keys, -1))
+        except Exception:
+            pass
+        _count_later(name, 'denied')
+        raise RateLimitExceeded(retry_after)
+
+
+def rate_limited(func):
+    ''' admission control for an endpoint method, see check '''
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, request, *args, **kwargs):
+        if ENABLED:
+            state = getattr(self, 'request_state', None)
+            check(name, request, getattr(state, 'remote_address', None))
+        return func(self, request, *args, **kwargs)
+    return wrapper
+
+
+def stats(names):
+    ''' returns {endpoint: {'checked', 'denied', 'admitted'}} for names.
+        denials are reported with the instance's next check '''
+    result = {}
+    for name in names:
+        values = memcache.get_multi([_stats_key(name, 'checked'), _stats_key(name, 'denied')])
+        checked = values.get(_stats_key(name, 'checked'), 0)
+        denied = values.get(_stats_key(name, 'denied'), 0)
+        result[name] = {'checked': checked, 'denied': denied,
+                        'admitted': max(checked - denied, 0)}
+    return result
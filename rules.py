@@ -0,0 +1,178 @@
+"""rules.py - The rules of Battleship, independent of how games are stored.
+
+The functions here work on any game object with p1, p2, status, winner,
+salvo and board attributes: an NDB Game (models.py) or a storage.MemoryGame.
+They only change the game in memory and return the records a storage backend
+has to write along with it; see storage.Storage.update_game."""
+
+from board import GameException, MAX_SIZE, on_board, random_fleet
+
+
+## Constants
+# the standard game; new_game can choose another board size and fleet
+SHIPS = {'Destroyer': 2, 'Cruiser': 3, 'Submarine': 3, 'Battleship': 4, 'Aircraft Carrier': 5}
+BOARD_SIZE = 10
+MIN_BOARD_SIZE = 5
+MAX_BOARD_SIZE = MAX_SIZE
+MAX_FLEET = 50
+MAX_SHIP_NAME = 40
+# most shots per turn; every shot of a salvo is checked and fired in one request
+MAX_SALVO = 10
+
+
+## records returned alongside a changed game
+# ('ship', player, ship_name, cells) a ship was placed
+# ('move', user_key, x, y)           a shot was fired
+# ('win', user_key)                  user_key won the game
+# ('notify', [(user, message)])      notifications to send once the change commits
+SHIP, MOVE, WIN, NOTIFY = 'ship', 'move', 'win', 'notify'
+
+
+def check_setup(size, ships):
+    '''
+    raises GameException unless a board of size with the fleet ships (ship
+    name -> length) can be played: every ship fits on the board and the
+    fleet covers at most half of it. that leaves random placement of a whole
+    fleet plenty of room, but ships placed by hand can still leave none for
+    the rest, see random_placements
+    '''
+    if not MIN_BOARD_SIZE <= size <= MAX_BOARD_SIZE:
+        raise GameException('The board size must be between {} and {}'.format(
+                MIN_BOARD_SIZE, MAX_BOARD_SIZE))
+    if not 0 < len(ships) <= MAX_FLEET:
+        raise GameException('A fleet has between 1 and {} ships'.format(MAX_FLEET))
+    for name, length in ships.items():
+        if not 0 < len(name) <= MAX_SHIP_NAME:
+            raise GameException('Ship names are 1 to {} characters long'.format(MAX_SHIP_NAME))
+        if not 0 < length <= size:
+            raise GameException('{} must be between 1 and {} cells long'.format(name, size))
+    if sum(ships.values()) * 2 > size * size:
+        raise GameException('The fleet must cover at most half of the board')
+
+
+def is_standard(size, ships):
+    ''' whether a game of size with fleet ships (None for SHIPS) is the
+        standard one. other games are always compact: the Ship, Position
+        and Move entities of an entity-tree game grow with the fleet and
+        shots, and a large fleet's would not fit in one commit '''
+    return size == BOARD_SIZE and ships in (None, SHIPS)
+
+
+def fleet(game):
+    ''' the game's ship name -> length. games without a board yet are standard '''
+    board = game.board
+    return board.ships if board is not None and board.ships else SHIPS
+
+
+def player_num(game, user_key):
+    ''' 1 or 2 depending on which player user_key is '''
+    return 1 if user_key == game.p1 else 2
+
+
+def remaining_ships(game):
+    ''' the ships not yet on each player's board, as a (player 1, player 2) tuple '''
+    ships = fleet(game)
+    return (game.board.remaining_ships(1, ships), game.board.remaining_ships(2, ships))
+
+
+def place_ships(game, player, placements):
+    '''
+    validates placements, a list of (ship_name, x, y, vertical), against the
+    board and places the valid ones. returns a list of (ship_name, error
+    message) and the records for the new ships
+    '''
+    ships = fleet(game)
+    errors = []
+    records = []
+    for ship_name, x, y, vertical in placements:
+        if ship_name not in ships:
+            errors.append((ship_name, 'Not a valid ship'))
+            continue
+        try:
+            cells = game.board.place(player, ship_name, x, y, ships[ship_name], vertical)
+        except GameException, e:
+            errors.append((ship_name, str(e)))
+            continue
+        records.append((SHIP, player, ship_name, cells))
+    return errors, records
+
+
+def random_placements(game, player):
+    ''' a random spot for each of player's remaining ships. raises
+        GameException if they can't be fitted around the ships already placed '''
+    board = game.board
+    ships = fleet(game)
+    return random_fleet({name: ships[name] for name in board.remaining_ships(player, ships)},
+                        board.size, board.occupied(player))
+
+
+def start_if_ready(game):
+    ''' starts the game once both fleets are complete '''
+    if game.status == 'setting up' and not any(remaining_ships(game)):
+        game.status = 'p1 move'
+
+
+def shots_per_turn(game, player):
+    ''' the game's salvo size, or fewer if player has fewer cells left to shoot at '''
+    board = game.board
+    left = board.size * board.size - len(board.shots[player - 1])
+    return min(game.salvo or 1, left)
+
+
+def fire(game, user_key, x, y):
+    ''' fire_salvo for a single shot at x,y, returning its board.Shot '''
+    shots, records = fire_salvo(game, user_key, [(x, y)])
+    return shots[0], records
+
+
+def fire_salvo(game, user_key, cells):
+    '''
+    fires all of user_key's shots for this turn at cells, a list of (x, y),
+    and passes the turn. every cell is checked before any is fired, and
+    there must be exactly shots_per_turn of them. returns the board.Shot of
+    each shot fired (a salvo stops at the shot that ends the game) and
+    their records. raises GameException if it is not user_key's turn or a
+    cell is off the board or already shot at
+    '''
+    player = player_num(game, user_key)
+    if game.status != 'p{} move'.format(player):
+        raise GameException('It is not your turn!')
+    board = game.board
+    expected = shots_per_turn(game, player)
+    if len(cells) != expected:
+        raise GameException('This game takes {} shots per turn'.format(expected))
+    seen = set()
+    for x, y in cells:
+        if not on_board(x, y, board.size):
+            raise GameException('Attempted move is off the board.')
+        if board.has_shot(player, x, y):
+            raise GameException('You already made that move')
+        if (x, y) in seen:
+            raise GameException('{}, {} is in the salvo twice'.format(x, y))
+        seen.add((x, y))
+
+    shots = []
+    records = []
+    for x, y in cells:
+        shot = board.fire(player, x, y)
+        shots.append(shot)
+        records.append((MOVE, user_key, x, y))
+        if shot.game_over:
+            break
+    if shots[-1].game_over:
+        game.status = 'game over'
+        game.winner = user_key
+        records.append((WIN, user_key))
+    else:
+        game.status = 'p{} move'.format(3 - player)
+    return shots, records
+
+
+def final_stats(game):
+    ''' (user_key, shots, hits, won) for each player of a finished game '''
+    board = game.board
+    stats = []
+    for player, user_key in ((1, game.p1), (2, game.p2)):
+        stats.append((user_key, len(board.shots[player - 1]),
+                      len(board.hits(3 - player)), user_key == game.winner))
+    return stats
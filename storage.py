@@ -0,0 +1,339 @@
+"""storage.py - Where games and users are kept.
+
+Storage is the interface the api handlers use for everything they read or
+write. ndb_storage.NdbStorage is the App Engine implementation used in
+production. MemoryStorage keeps everything in process, with the same
+semantics, so the rules and handlers can be run and benchmarked without the
+SDK or a datastore emulator. Neither backend knows the rules of the game; those
+live in rules.py.
+
+Users have key, name and email attributes. Games have p1, p2 and winner
+(user keys), status, board (a board.Board), compact, salvo, version and
+created.
+Each backend chooses what its keys are; handlers only compare them and pass
+them back in."""
+
+import copy
+import threading
+from collections import deque
+from datetime import datetime
+
+from board import Board, GameException
+import rules
+
+
+## errors
+class InvalidId(ValueError):
+    ''' a game id that is malformed or names something other than a game '''
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Contention(Exception):
+    ''' update_game gave up because the game kept changing underneath it '''
+
+
+class Result(object):
+    ''' an already finished future, for backends that never wait '''
+    def __init__(self, value):
+        self.value = value
+
+    def get_result(self):
+        return self.value
+
+
+class Storage(object):
+    ''' what the handlers need from a backend. methods ending in _async
+        return futures (anything with get_result) so independent reads can
+        overlap '''
+
+    ## users
+    def user_by_name_async(self, name):
+        raise NotImplementedError
+
+    def user_key(self, name):
+        ''' the key of the user called name, or None '''
+        raise NotImplementedError
+
+    def get_user_async(self, user_key):
+        raise NotImplementedError
+
+    def create_user(self, name, email=None):
+        ''' creates a user, or returns None if the name is already taken '''
+        raise NotImplementedError
+
+    def user_names(self, user_keys):
+        ''' a dict of user key -> name for user_keys '''
+        raise NotImplementedError
+
+    ## games
+    def new_game(self, p1, p2, compact=False, salvo=1, size=rules.BOARD_SIZE, ships=None):
+        ''' a new game on a size x size board. ships is the fleet (ship name
+            -> length) if it isn't the standard one; see rules.check_setup.
+            games that aren't standard are always compact, see rules.is_standard '''
+        raise NotImplementedError
+
+    def game_id(self, game):
+        ''' the string clients use to refer to game '''
+        raise NotImplementedError
+
+    def get_game_async(self, game_id):
+        ''' the game, or None if it does not exist. raises InvalidId '''
+        raise NotImplementedError
+
+    def game_version(self, game_id):
+        ''' the game's current version without loading it where possible,
+            or None if it does not exist. raises InvalidId '''
+        raise NotImplementedError
+
+    def board(self, game):
+        ''' the game's board, loading it if needed '''
+        return game.board
+
+    def update_game(self, game, fn, name=None):
+        '''
+        atomically re-reads game, calls fn with the fresh copy and writes
+        it back along with the records fn returns (see rules.py). fn returns
+        (result, records); records of None means nothing is written. fn may
+        raise to abort. on success game gets the written state and result is
+        returned. name, if given, labels the transaction in any stats the
+        backend keeps. raises Contention if the backend gives up retrying
+        '''
+        raise NotImplementedError
+
+    def delete_game(self, game):
+        raise NotImplementedError
+
+    def ship_dates(self, game):
+        ''' {(user key, ship name): date placed}, where the backend knows it '''
+        raise NotImplementedError
+
+    def active_games(self, user_key, page_size, cursor=None):
+        ''' (games, next cursor or None) for one page of user_key's unfinished
+            games, oldest first. raises InvalidCursor '''
+        raise NotImplementedError
+
+    def rankings(self, page_size, cursor=None):
+        ''' ([(name, wins)], next cursor or None) ordered by wins.
+            raises InvalidCursor '''
+        raise NotImplementedError
+
+    def stats(self, user_key=None):
+        '''
+        statistics over finished games as a dict: games_finished and
+        average_moves_to_win (None before any game has finished), plus
+        user_key's games_played, wins and hit_ratio if given. may lag a
+        just-finished game
+        '''
+        raise NotImplementedError
+
+
+class MemoryUser(object):
+    def __init__(self, key, name, email=None):
+        self.key = key
+        self.name = name
+        self.email = email
+        self.created = datetime.utcnow()
+
+
+class MemoryGame(object):
+    def __init__(self, key, p1, p2, compact=False, salvo=1, size=rules.BOARD_SIZE, ships=None):
+        self.key = key
+        self.p1 = p1
+        self.p2 = p2
+        self.status = 'setting up'
+        self.winner = None
+        self.board = Board(size, ships)
+        self.compact = compact
+        self.salvo = salvo
+        self.version = 1
+        self.created = datetime.utcnow()
+
+
+def _freeze(game):
+    ''' game as MemoryStorage keeps it: the same attributes, board packed '''
+    frozen = copy.copy(game)
+    frozen.board = game.board.to_bytes()
+    return frozen
+
+
+def _thaw(frozen):
+    ''' a game of its own from a frozen one '''
+    game = copy.copy(frozen)
+    game.board = Board.from_bytes(frozen.board)
+    return game
+
+
+def _offset(cursor):
+    try:
+        offset = int(cursor or 0)
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if offset < 0:
+        raise InvalidCursor(cursor)
+    return offset
+
+
+def _page(items, page_size, cursor):
+    start = _offset(cursor)
+    end = start + page_size
+    return items[start:end], str(end) if end < len(items) else None
+
+
+class MemoryStorage(Storage):
+    '''
+    keeps users and games in dicts behind one lock. keys are ints handed out
+    in creation order and game ids are those ints as strings. games are kept
+    with their boards packed, as a compact game is in the datastore, so every
+    read unpacks a game of its own and update_game packs the one fn changed:
+    callers get the same isolation they get from the datastore for one copy
+    of the board each way. notifications are not sent but kept in notices,
+    most recent last
+    '''
+
+    def __init__(self, keep_notices=1000):
+        self._lock = threading.Lock()
+        self._next_key = 1
+        self._users = {}
+        self._user_keys = {}
+        self._games = {}
+        self._ship_dates = {}
+        self._wins = {}
+        self._games_finished = 0
+        self._winning_moves = 0
+        # user key -> [games, wins, shots, hits]
+        self._user_stats = {}
+        self.notices = deque(maxlen=keep_notices)
+
+    def _new_key(self):
+        key = self._next_key
+        self._next_key += 1
+        return key
+
+    def user_by_name_async(self, name):
+        with self._lock:
+            return Result(copy.copy(self._users.get(self._user_keys.get(name))))
+
+    def user_key(self, name):
+        return self._user_keys.get(name)
+
+    def get_user_async(self, user_key):
+        with self._lock:
+            return Result(copy.copy(self._users.get(user_key)))
+
+    def create_user(self, name, email=None):
+        with self._lock:
+            if name in self._user_keys:
+                return None
+            user = MemoryUser(self._new_key(), name, email)
+            self._users[user.key] = user
+            self._user_keys[name] = user.key
+            self._wins[user.key] = 0
+            return copy.copy(user)
+
+    def user_names(self, user_keys):
+        with self._lock:
+            return {k: self._users[k].name for k in user_keys if k in self._users}
+
+    def new_game(self, p1, p2, compact=False, salvo=1, size=rules.BOARD_SIZE, ships=None):
+        compact = compact or not rules.is_standard(size, ships)
+        with self._lock:
+            game = MemoryGame(self._new_key(), p1, p2, compact, salvo, size, ships)
+            self._games[game.key] = _freeze(game)
+            return game
+
+    def game_id(self, game):
+        return str(game.key)
+
+    def _key(self, game_id):
+        try:
+            return int(game_id)
+        except (TypeError, ValueError):
+            raise InvalidId(game_id)
+
+    def get_game_async(self, game_id):
+        key = self._key(game_id)
+        with self._lock:
+            frozen = self._games.get(key)
+        return Result(_thaw(frozen) if frozen else None)
+
+    def game_version(self, game_id):
+        key = self._key(game_id)
+        with self._lock:
+            game = self._games.get(key)
+            return game.version if game else None
+
+    def update_game(self, game, fn, name=None):
+        with self._lock:
+            if game.key not in self._games:
+                raise GameException('Game not found!')
+            current = _thaw(self._games[game.key])
+            result, records = fn(current)
+            if records is None:
+                return result
+            current.version += 1
+            self._games[game.key] = _freeze(current)
+            now = datetime.utcnow()
+            for record in records:
+                if record[0] == rules.SHIP and not current.compact:
+                    player, ship_name = record[1], record[2]
+                    user_key = current.p1 if player == 1 else current.p2
+                    self._ship_dates[(current.key, user_key, ship_name)] = now
+                elif record[0] == rules.WIN:
+                    self._wins[record[1]] += 1
+                    self._add_stats(current)
+                elif record[0] == rules.NOTIFY:
+                    self.notices.extend((user.name, current.key, message)
+                                        for user, message in record[1])
+            game.__dict__.update(current.__dict__)
+            return result
+
+    def _add_stats(self, game):
+        self._games_finished += 1
+        for user_key, shots, hits, won in rules.final_stats(game):
+            stats = self._user_stats.setdefault(user_key, [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += won
+            stats[2] += shots
+            stats[3] += hits
+            if won:
+                self._winning_moves += shots
+
+    def delete_game(self, game):
+        with self._lock:
+            self._games.pop(game.key, None)
+            for k in [k for k in self._ship_dates if k[0] == game.key]:
+                del self._ship_dates[k]
+
+    def ship_dates(self, game):
+        with self._lock:
+            return {(user_key, ship_name): created
+                    for (key, user_key, ship_name), created in self._ship_dates.items()
+                    if key == game.key}
+
+    def active_games(self, user_key, page_size, cursor=None):
+        with self._lock:
+            games = sorted((g for g in self._games.values()
+                            if user_key in (g.p1, g.p2) and g.status != 'game over'),
+                           key=lambda g: g.key)
+            games, next_cursor = _page(games, page_size, cursor)
+        return [_thaw(g) for g in games], next_cursor
+
+    def rankings(self, page_size, cursor=None):
+        with self._lock:
+            ranked = sorted(self._wins.items(), key=lambda (k, wins): (-wins, k))
+            page, next_cursor = _page(ranked, page_size, cursor)
+            return [(self._users[k].name, wins) for k, wins in page], next_cursor
+
+    def stats(self, user_key=None):
+        with self._lock:
+            games = self._games_finished
+            result = {'games_finished': games,
+                      'average_moves_to_win': self._winning_moves / float(games) if games else None}
+            if user_key:
+                played, wins, shots, hits = self._user_stats.get(user_key, [0, 0, 0, 0])
+                result.update(games_played=played, wins=wins,
+                              hit_ratio=hits / float(shots) if shots else None)
+            return result
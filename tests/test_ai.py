@@ -0,0 +1,97 @@
+"""test_ai.py - Tests for ai.py."""
+
+import random
+import unittest
+
+import ai
+from board import Board, cell
+import rules
+from storage import MemoryGame
+
+
+def _play(size, ships=None, salvo=1, seed=1):
+    ''' plays a whole game of the computer against itself, returns it '''
+    rng = random.Random(seed)
+    game = MemoryGame(1, 'alice', 'bob', salvo=salvo, size=size, ships=ships)
+    for player in (1, 2):
+        rules.place_ships(game, player, rules.random_placements(game, player))
+    rules.start_if_ready(game)
+    while game.status != 'game over':
+        player = 1 if game.status == 'p1 move' else 2
+        salvo = ai.choose_salvo(game.board, player, rules.shots_per_turn(game, player), rng)
+        rules.fire_salvo(game, (game.p1, game.p2)[player - 1], salvo)
+    return game
+
+
+class HeatmapTest(unittest.TestCase):
+    def test_blocked_cells_are_cold(self):
+        board = Board(10)
+        board.place(2, 'Destroyer', 0, 0, 2)
+        board.fire(1, 5, 5)
+        heat = ai.heatmap(board, 1)
+        self.assertEqual(heat[cell(5, 5, 10)], 0)
+        self.assertTrue(heat[cell(4, 5, 10)] > 0)
+
+    def test_targets_around_hits(self):
+        board = Board(10)
+        board.place(2, 'Destroyer', 4, 4, 2)
+        for name, x, y, vertical in [('Cruiser', 0, 0, False), ('Submarine', 0, 2, False),
+                                     ('Battleship', 0, 8, False),
+                                     ('Aircraft Carrier', 5, 9, False)]:
+            board.place(2, name, x, y, rules.SHIPS[name], vertical)
+        board.fire(1, 4, 4)
+        x, y = ai.choose_shot(board, 1, random.Random(1))
+        self.assertIn((x, y), [(3, 4), (5, 4), (4, 3), (4, 5)])
+
+    @unittest.skipIf(ai.numpy is None, 'needs NumPy')
+    def test_numpy_matches_pure_python(self):
+        board = Board(10)
+        board.place(2, 'Destroyer', 4, 4, 2)
+        board.fire(1, 4, 4)
+        board.fire(1, 7, 7)
+        with_numpy = list(ai.heatmap(board, 1))
+        # the placement tables are cached in NumPy's form, so use fresh ones
+        numpy, tables = ai.numpy, ai._tables
+        ai.numpy, ai._tables = None, {}
+        try:
+            self.assertEqual(ai.heatmap(board, 1), with_numpy)
+        finally:
+            ai.numpy, ai._tables = numpy, tables
+
+
+class SalvoTest(unittest.TestCase):
+    def test_salvo_cells_are_new(self):
+        board = Board(10)
+        for c in range(0, 100, 3):
+            board.shots[0].add(c)
+        salvo = ai.choose_salvo(board, 1, 10, random.Random(1))
+        cells = [cell(x, y, 10) for x, y in salvo]
+        self.assertEqual(len(set(cells)), 10)
+        self.assertFalse(set(cells) & board.shots[0])
+
+    def test_hunt_fills_the_board(self):
+        board = Board(30, {'A': 2})
+        board.place(2, 'A', 0, 0, 2)
+        taken = set(random.Random(2).sample(range(900), 850))
+        board.shots[0].update(taken)
+        salvo = ai.choose_salvo(board, 1, 50, random.Random(1))
+        cells = set(cell(x, y, 30) for x, y in salvo)
+        self.assertEqual(cells, set(range(900)) - taken)
+
+
+class GameTest(unittest.TestCase):
+    def test_heatmap_game(self):
+        game = _play(10)
+        self.assertIn(game.winner, ('alice', 'bob'))
+
+    def test_salvo_game(self):
+        game = _play(10, salvo=3)
+        self.assertIn(game.winner, ('alice', 'bob'))
+
+    def test_hunt_and_target_game(self):
+        game = _play(40, {'A': 5, 'B': 4, 'C': 3, 'D': 2})
+        self.assertIn(game.winner, ('alice', 'bob'))
+
+
+if __name__ == '__main__':
+    unittest.main()
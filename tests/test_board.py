@@ -0,0 +1,96 @@
+"""test_board.py - Tests for board.py."""
+
+import random
+import unittest
+from datetime import datetime
+
+from board import Board, GameException, MAX_SIZE, cell, random_fleet
+import rules
+
+
+class BoardTest(unittest.TestCase):
+    def setUp(self):
+        self.board = Board(10)
+        self.board.place(1, 'Destroyer', 0, 0, 2)
+        self.board.place(2, 'Cruiser', 3, 3, 3, vertical=True)
+
+    def test_place(self):
+        self.assertEqual(self.board.fleets[1]['Cruiser'], (33, 43, 53))
+        self.assertEqual(self.board.occupied(1), {0: 'Destroyer', 1: 'Destroyer'})
+        self.assertEqual(self.board.remaining_ships(1, rules.SHIPS),
+                         [n for n in rules.SHIPS if n != 'Destroyer'])
+
+    def test_place_rejects_overlap_and_repeats(self):
+        self.assertRaises(GameException, self.board.place, 1, 'Cruiser', 1, 0, 3, True)
+        self.assertRaises(GameException, self.board.place, 1, 'Destroyer', 5, 5, 2)
+        self.assertRaises(GameException, self.board.place, 1, 'Cruiser', 9, 0, 3)
+
+    def test_fire(self):
+        self.assertFalse(self.board.fire(2, 5, 5).hit)
+        shot = self.board.fire(2, 0, 0)
+        self.assertEqual((shot.hit, shot.ship, shot.sunk, shot.game_over),
+                         (True, 'Destroyer', False, False))
+        shot = self.board.fire(2, 1, 0)
+        self.assertEqual((shot.sunk, shot.game_over), (True, True))
+        self.assertEqual(sorted(self.board.hits(1)), [0, 1])
+        self.assertEqual(self.board.misses(1), [55])
+        self.assertEqual(len(self.board.moves), 3)
+
+    def test_repeat_shot_does_not_sink(self):
+        self.board.fire(1, 3, 3)
+        self.board.fire(1, 3, 3)
+        self.assertFalse(self.board.fire(1, 3, 4).sunk)
+
+    def test_fire_off_board(self):
+        self.assertRaises(GameException, self.board.fire, 1, 10, 0)
+
+    def test_clear_shots(self):
+        self.board.fire(2, 0, 0)
+        self.board.clear_shots()
+        self.assertEqual(self.board.shots, [set(), set()])
+        self.assertEqual(self.board.moves, [])
+        self.assertFalse(self.board.fire(2, 1, 0).sunk)
+
+    def test_round_trip(self):
+        self.board.fire(2, 0, 0, datetime(2020, 1, 2, 3, 4, 5))
+        self.board.fire(1, 3, 4, datetime(2020, 1, 2, 3, 4, 6))
+        copy = Board.from_bytes(self.board.to_bytes())
+        self.assertEqual(copy.size, 10)
+        self.assertEqual(copy.ships, None)
+        self.assertEqual(copy.fleets, self.board.fleets)
+        self.assertEqual(copy.owners, self.board.owners)
+        self.assertEqual(copy.shots, self.board.shots)
+        self.assertEqual(copy.moves, self.board.moves)
+        self.assertFalse(copy.fire(2, 9, 9).hit)
+        self.assertTrue(copy.fire(2, 1, 0).game_over)
+
+    def test_round_trip_custom_fleet(self):
+        ships = {u'Dingh\xe9': 1, 'Long': MAX_SIZE}
+        board = Board(MAX_SIZE, ships)
+        board.place(1, 'Long', 0, MAX_SIZE - 1, MAX_SIZE)
+        board.place(1, u'Dingh\xe9', 0, 0, 1)
+        board.fire(2, MAX_SIZE - 1, MAX_SIZE - 1)
+        copy = Board.from_bytes(board.to_bytes())
+        self.assertEqual(copy.ships, ships)
+        self.assertEqual(copy.fleets, board.fleets)
+        self.assertEqual(copy.shots, board.shots)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, Board.from_bytes, '\x02' + self.board.to_bytes()[1:])
+
+    def test_random_fleet(self):
+        ships = {'S%d' % i: 2 + i % 8 for i in range(rules.MAX_FLEET)}
+        placed = Board(MAX_SIZE, ships)
+        occupied = {cell(0, 0, MAX_SIZE): 'Taken'}
+        for name, x, y, vertical in random_fleet(ships, MAX_SIZE, occupied, random.Random(1)):
+            cells = placed.place(1, name, x, y, ships[name], vertical)
+            self.assertNotIn(0, cells)
+        self.assertEqual(placed.remaining_ships(1, ships), [])
+
+    def test_random_fleet_without_room(self):
+        self.assertRaises(GameException, random_fleet, {'a': 5, 'b': 5}, 5,
+                          {cell(i, i, 5): 'x' for i in range(5)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""test_rules.py - Tests for rules.py."""
+
+import unittest
+
+from board import GameException, cell
+import rules
+from storage import MemoryGame
+
+
+def _game(salvo=1, size=rules.BOARD_SIZE, ships=None):
+    ''' a game with both fleets in the top rows, ready for player 1's move '''
+    game = MemoryGame(1, 'alice', 'bob', salvo=salvo, size=size, ships=ships)
+    placements = [(name, 0, y, False) for y, name in enumerate(sorted(rules.fleet(game)))]
+    for player in (1, 2):
+        errors, records = rules.place_ships(game, player, placements)
+        assert not errors, errors
+    rules.start_if_ready(game)
+    return game
+
+
+class SetupTest(unittest.TestCase):
+    def test_check_setup(self):
+        rules.check_setup(rules.BOARD_SIZE, rules.SHIPS)
+        rules.check_setup(rules.MAX_BOARD_SIZE, {'A': rules.MAX_BOARD_SIZE})
+        for size, ships in [(rules.MIN_BOARD_SIZE - 1, rules.SHIPS),
+                            (rules.MAX_BOARD_SIZE + 1, rules.SHIPS),
+                            (10, {}),
+                            (10, {'': 2}),
+                            (10, {'x' * (rules.MAX_SHIP_NAME + 1): 2}),
+                            (10, {'Long': 11}),
+                            (10, {'Zero': 0}),
+                            (5, {'a': 5, 'b': 5, 'c': 5}),
+                            (100, {'S%d' % i: 2 for i in range(rules.MAX_FLEET + 1)})]:
+            self.assertRaises(GameException, rules.check_setup, size, ships)
+
+    def test_is_standard(self):
+        self.assertTrue(rules.is_standard(rules.BOARD_SIZE, None))
+        self.assertTrue(rules.is_standard(rules.BOARD_SIZE, dict(rules.SHIPS)))
+        self.assertFalse(rules.is_standard(12, None))
+        self.assertFalse(rules.is_standard(rules.BOARD_SIZE, {'A': 2}))
+
+    def test_place_ships(self):
+        game = MemoryGame(1, 'alice', 'bob')
+        errors, records = rules.place_ships(game, 1, [
+                ('Destroyer', 0, 0, False), ('Rowboat', 0, 1, False),
+                ('Cruiser', 1, 0, True), ('Submarine', 9, 9, False)])
+        self.assertEqual([name for name, error in errors], ['Rowboat', 'Cruiser', 'Submarine'])
+        self.assertEqual(records, [(rules.SHIP, 1, 'Destroyer', (0, 1))])
+        rules.start_if_ready(game)
+        self.assertEqual(game.status, 'setting up')
+
+    def test_random_placements(self):
+        game = MemoryGame(1, 'alice', 'bob', size=30, ships={'A': 5, 'B': 30})
+        game.board.place(1, 'A', 0, 0, 5)
+        placements = rules.random_placements(game, 1)
+        self.assertEqual([p[0] for p in placements], ['B'])
+        errors, records = rules.place_ships(game, 1, placements)
+        self.assertEqual(errors, [])
+
+
+class FireTest(unittest.TestCase):
+    def test_turns(self):
+        game = _game()
+        self.assertRaises(GameException, rules.fire, game, 'bob', 5, 5)
+        shot, records = rules.fire(game, 'alice', 5, 5)
+        self.assertFalse(shot.hit)
+        self.assertEqual(records, [(rules.MOVE, 'alice', 5, 5)])
+        self.assertEqual(game.status, 'p2 move')
+        self.assertRaises(GameException, rules.fire, game, 'alice', 6, 6)
+
+    def test_invalid_shots(self):
+        game = _game()
+        rules.fire(game, 'alice', 5, 5)
+        rules.fire(game, 'bob', 5, 5)
+        self.assertRaises(GameException, rules.fire, game, 'alice', 5, 5)
+        self.assertRaises(GameException, rules.fire, game, 'alice', 10, 5)
+        self.assertEqual(game.status, 'p1 move')
+
+    def test_salvo(self):
+        game = _game(salvo=3)
+        self.assertRaises(GameException, rules.fire_salvo, game, 'alice', [(5, 5), (6, 6)])
+        self.assertRaises(GameException, rules.fire_salvo, game, 'alice',
+                          [(5, 5), (6, 6), (5, 5)])
+        self.assertEqual(game.board.shots[0], set())
+        shots, records = rules.fire_salvo(game, 'alice', [(0, 0), (1, 0), (5, 5)])
+        self.assertEqual([s.hit for s in shots], [True, True, False])
+        self.assertEqual(len(records), 3)
+
+    def test_shots_per_turn(self):
+        game = _game(salvo=3, size=5, ships={'A': 1})
+        for c in range(23):
+            game.board.shots[0].add(c)
+        self.assertEqual(rules.shots_per_turn(game, 1), 2)
+        self.assertEqual(rules.shots_per_turn(game, 2), 3)
+
+    def test_win(self):
+        game = _game(size=5, ships={'A': 2})
+        rules.fire(game, 'alice', 0, 0)
+        rules.fire(game, 'bob', 4, 4)
+        shot, records = rules.fire(game, 'alice', 1, 0)
+        self.assertTrue(shot.game_over)
+        self.assertEqual(records[-1], (rules.WIN, 'alice'))
+        self.assertEqual((game.status, game.winner), ('game over', 'alice'))
+        self.assertEqual(rules.final_stats(game),
+                         [('alice', 2, 2, True), ('bob', 1, 0, False)])
+
+    def test_salvo_stops_at_win(self):
+        game = _game(salvo=3, size=5, ships={'A': 1})
+        shots, records = rules.fire_salvo(game, 'alice', [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual(len(shots), 1)
+        self.assertNotIn(cell(1, 1, 5), game.board.shots[0])
+        self.assertEqual(game.winner, 'alice')
+
+
+if __name__ == '__main__':
+    unittest.main()
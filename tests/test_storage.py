@@ -0,0 +1,116 @@
+"""test_storage.py - Tests for storage.MemoryStorage."""
+
+import unittest
+
+from board import GameException
+import rules
+from storage import InvalidCursor, InvalidId, MemoryStorage
+
+
+def _place_all(game):
+    records = []
+    for player in (1, 2):
+        records.extend(rules.place_ships(game, player, rules.random_placements(game, player))[1])
+    rules.start_if_ready(game)
+    return None, records
+
+
+class UserTest(unittest.TestCase):
+    def test_users(self):
+        storage = MemoryStorage()
+        alice = storage.create_user('alice', 'alice@example.com')
+        self.assertIsNone(storage.create_user('alice'))
+        self.assertEqual(storage.user_key('alice'), alice.key)
+        self.assertEqual(storage.user_by_name_async('alice').get_result().email,
+                         'alice@example.com')
+        self.assertIsNone(storage.user_by_name_async('bob').get_result())
+        self.assertEqual(storage.user_names([alice.key, 99]), {alice.key: 'alice'})
+
+
+class GameTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.alice = self.storage.create_user('alice')
+        self.bob = self.storage.create_user('bob')
+        self.game = self.storage.new_game(self.alice.key, self.bob.key)
+        self.game_id = self.storage.game_id(self.game)
+
+    def _get(self):
+        return self.storage.get_game_async(self.game_id).get_result()
+
+    def test_new_game(self):
+        self.assertFalse(self.game.compact)
+        game = self.storage.new_game(self.alice.key, self.bob.key, size=12)
+        self.assertTrue(game.compact)
+        self.assertEqual(self._get().board.size, rules.BOARD_SIZE)
+
+    def test_ids(self):
+        self.assertRaises(InvalidId, self.storage.get_game_async, 'abc')
+        self.assertIsNone(self.storage.get_game_async('99').get_result())
+        self.assertIsNone(self.storage.game_version('99'))
+
+    def test_reads_are_isolated(self):
+        game = self._get()
+        game.board.fire(1, 0, 0)
+        game.status = 'game over'
+        self.assertEqual(self._get().board.shots, [set(), set()])
+        self.assertEqual(self._get().status, 'setting up')
+        self.assertEqual(self.game.board.shots, [set(), set()])
+
+    def test_update_game(self):
+        self.storage.update_game(self.game, _place_all, 'place')
+        self.assertEqual(self.game.status, 'p1 move')
+        self.assertEqual(self.game.version, 2)
+        self.assertEqual(self.storage.game_version(self.game_id), 2)
+        stored = self._get()
+        self.assertEqual(stored.board.fleets, self.game.board.fleets)
+        self.assertEqual(len(self.storage.ship_dates(stored)), len(rules.SHIPS) * 2)
+
+        # the caller's copy isn't the stored one
+        self.game.board.fire(1, 0, 0)
+        self.assertEqual(self._get().board.shots, [set(), set()])
+
+    def test_update_game_without_records(self):
+        result = self.storage.update_game(self.game, lambda game: ('nothing', None))
+        self.assertEqual(result, 'nothing')
+        self.assertEqual(self.storage.game_version(self.game_id), 1)
+
+    def test_update_game_raises(self):
+        def fail(game):
+            game.status = 'p1 move'
+            raise GameException('No')
+        self.assertRaises(GameException, self.storage.update_game, self.game, fail)
+        self.assertEqual(self._get().status, 'setting up')
+        self.storage.delete_game(self.game)
+        self.assertRaises(GameException, self.storage.update_game, self.game, _place_all)
+
+    def test_finished_game(self):
+        self.storage.update_game(self.game, _place_all)
+        alice, bob = self.alice.key, self.bob.key
+        fleet = self.game.board.fleets[1]
+        targets = sorted(c for cells in fleet.values() for c in cells)
+        misses = iter(c for c in range(100) if c not in self.game.board.owners[0])
+        for c in targets:
+            self.storage.update_game(self.game, lambda game: rules.fire(game, alice, c % 10, c // 10))
+            if self.game.status == 'game over':
+                break
+            m = next(misses)
+            self.storage.update_game(self.game, lambda game: rules.fire(game, bob, m % 10, m // 10))
+        self.assertEqual(self._get().winner, alice)
+        self.assertEqual(len(self._get().board.moves), len(targets) * 2 - 1)
+        stats = self.storage.stats(alice)
+        self.assertEqual((stats['games_finished'], stats['wins']), (1, 1))
+        self.assertEqual(self.storage.rankings(10), ([('alice', 1), ('bob', 0)], None))
+        self.assertEqual(self.storage.active_games(alice, 10), ([], None))
+
+    def test_active_games(self):
+        other = self.storage.new_game(self.bob.key, self.alice.key)
+        games, cursor = self.storage.active_games(self.alice.key, 1)
+        self.assertEqual([g.key for g in games], [self.game.key])
+        games, cursor = self.storage.active_games(self.alice.key, 1, cursor)
+        self.assertEqual(([g.key for g in games], cursor), ([other.key], None))
+        self.assertRaises(InvalidCursor, self.storage.active_games, self.alice.key, 1, '-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
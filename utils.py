@@ -1,25 +1,19 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+from collections import OrderedDict
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 import endpoints
 
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
-    Args:
-        urlsafe: A urlsafe key string
-        model: The expected entity kind
-    Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+def key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key a urlsafe key string encodes, without fetching it.
     Raises:
-        ValueError:"""
+        endpoints.BadRequestException: if the key String is malformed"""
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -28,9 +22,50 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+
+class LRUCache(object):
+    """A small thread-safe in-process cache that evicts the least recently
+        used entry once it holds max_size entries. Lives as long as the
+        instance does, so only use it for values that never change, or that
+        are replaced with set when they do."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+def record_transaction(name, attempts, failed=False):
+    """Counts a transaction's attempts, retries (attempts after the first,
+        i.e. contention) and whether it ultimately failed, in memcache
+        counters prefixed 'txn:<name>:'. Retries are also logged."""
+    retries = max(attempts - 1, 0)
+    if retries or failed:
+        logging.warning('Transaction %s: %d retries%s', name, retries,
+                        ', gave up' if failed else '')
+    memcache.offset_multi({'attempts': attempts,
+                           'retries': retries,
+                           'failed': int(failed)},
+                          key_prefix='txn:{}:'.format(name),
+                          initial_value=0)
+
+
+def transaction_stats(name):
+    """Returns the counters record_transaction keeps for name as a dict"""
+    stats = memcache.get_multi(['attempts', 'retries', 'failed'],
+                               key_prefix='txn:{}:'.format(name))
+    return {k: stats.get(k, 0) for k in ('attempts', 'retries', 'failed')}